@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+''' Benchmarks of the sync and display paths, run against the local
+stand-in NASA API in fakenasa.py. Results are printed, or written with
+--output, as JSON so that releases can be compared.
+
+Usage: bench.py [--latency=<ms>] [--bandwidth=<kB/s>] [--images=<count>]
+                [--rounds=<count>] [--output=<file>]
+'''
+
+import os
+import sys
+import json
+import time
+import getopt
+import platform
+import tempfile
+import statistics
+import logging
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, "..", "bin"))
+
+import fakenasa
+import ratelimit
+import nasa
+import catalog
+import derivatives
+import slideshow
+import sync
+
+if "DISPLAY" not in os.environ:
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+try:
+    from PyQt5 import QtWidgets
+    import qtviews
+except ImportError:
+    qtviews = None
+
+
+logger = logging.getLogger("bench")
+
+DISPLAY_SIZE = (1920, 1080)
+
+# ------------------------------------------------------------------------------
+
+def summarize(times):
+    ''' Return latency statistics of a list of seconds, in milliseconds '''
+    times = sorted(times)
+    return {
+        "count": len(times),
+        "mean": statistics.mean(times) * 1000,
+        "p50": times[len(times) // 2] * 1000,
+        "p95": times[min(len(times) - 1, int(len(times) * 0.95))] * 1000,
+        "max": times[-1] * 1000,
+    }
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return (result, time.perf_counter() - start)
+
+
+class Bench():
+    def __init__(self, fake, rounds, rover="curiosity"):
+        self.fake = fake
+        self.rounds = rounds
+        self.rover = rover
+        self.api = nasa.makeApi("BENCH", rover)
+        self.nextSol = 0
+
+
+    def takeSol(self):
+        ''' Return a sol not synced yet, so every round downloads '''
+        sol = self.nextSol
+        self.nextSol += 1
+        return sol
+
+
+    def benchSync(self):
+        ''' Sync of the images of one camera at one sol, end to end '''
+        rounds = []
+        for i in range(self.rounds):
+            before = self.fake.getStats()
+            s = sync.RoverCameraSync(self.api, sol=self.takeSol(), displaySize=DISPLAY_SIZE)
+            files, seconds = timed(s.sync)
+            sent = self.fake.getStats()["bytesSent"] - before["bytesSent"]
+            rounds.append({ "files": len(files or []), "bytes": sent, "seconds": seconds })
+
+        seconds = sum(map(lambda i: i["seconds"], rounds))
+        return {
+            "rounds": rounds,
+            "imagesPerSecond": sum(map(lambda i: i["files"], rounds)) / seconds,
+            "bytesPerSecond": sum(map(lambda i: i["bytes"], rounds)) / seconds,
+        }
+
+
+    def benchComposite(self):
+        ''' Hazcam dashboard: download of the tiles and the composite '''
+        times = []
+        for i in range(self.rounds):
+            s = sync.RoverHazcamSync(self.api, self.takeSol(), displaySize=DISPLAY_SIZE)
+            files, seconds = timed(s.sync)
+            times.append(seconds)
+        return summarize(times)
+
+
+    def benchDecode(self, files):
+        ''' Decode and scale to the display size: PIL derivatives and,
+        if PyQt is available, the viewer's image cache '''
+        result = {}
+        times = []
+        for i in files:
+            # Made again, not found up to date
+            if os.path.exists(derivatives.getPath(i)): os.unlink(derivatives.getPath(i))
+            times.append(timed(derivatives.make, i, DISPLAY_SIZE)[1])
+        result["derivative"] = summarize(times)
+
+        if qtviews:
+            cache = qtviews.ImageCache(DISPLAY_SIZE[0], DISPLAY_SIZE[1], 0)
+            result["viewer"] = summarize(list(map(lambda i: timed(cache.load, i)[1], files)))
+        return result
+
+
+    def benchSlideshow(self, files, interval=0.2):
+        ''' Time of advancing the slideshow to an image that is shown from
+        the viewer's cache, with and without prefetching '''
+        if qtviews is None: return None
+        result = {}
+        for prefetch in (0, 3):
+            viewer = BenchViewer(prefetch)
+            show = slideshow.Slideshow(viewer)
+            show.add(files)
+            times = []
+            for i in range(len(files)):
+                times.append(timed(show.nextImage)[1])
+                time.sleep(interval)
+            result["prefetch%d" % prefetch] = summarize(times)
+        return result
+
+
+class BenchViewer():
+    ''' Viewer that decodes images in the calling thread, like the viewer
+    does in the GUI thread, without showing them '''
+
+    def __init__(self, prefetchCount):
+        self.prefetchCount = prefetchCount
+        self.cache = qtviews.ImageCache(DISPLAY_SIZE[0], DISPLAY_SIZE[1], 256 * 1024 * 1024)
+
+    def show(self, path):
+        self.cache.get(path)
+
+    def prefetch(self, paths):
+        self.cache.prefetch(paths)
+
+
+# ------------------------------------------------------------------------------
+
+def run(latency, bandwidth, images, rounds):
+    workDir = tempfile.mkdtemp(prefix="duna-bench-")
+    os.chdir(workDir)
+
+    # Measure the code, not the API quota
+    ratelimit.REQUESTS_PER_HOUR = 1e9
+    ratelimit.BURST = 1e6
+
+    fake = fakenasa.FakeNasa(latency, bandwidth, images, sols=4 * rounds)
+    nasa.NasaApi.BASE_URL = fake.start()
+    sync.setup()
+    if qtviews: app = QtWidgets.QApplication([])
+
+    bench = Bench(fake, rounds)
+    results = {}
+    results["sync"] = bench.benchSync()
+    results["composite"] = bench.benchComposite()
+
+    originals = catalog.db.listImages(bench.rover, catalog.CAMERA, 0)
+    results["decode"] = bench.benchDecode(originals)
+    shown = sync.makeDisplayImages(originals, DISPLAY_SIZE)
+    results["slideshow"] = bench.benchSlideshow(shown)
+
+    fake.stop()
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "parameters": {
+            "latency": latency,
+            "bandwidth": bandwidth,
+            "imagesPerSol": images,
+            "imageSize": fake.imageSize,
+            "rounds": rounds,
+            "displaySize": DISPLAY_SIZE,
+        },
+        "server": fake.getStats(),
+        "workDir": workDir,
+        "results": results,
+    }
+
+
+def main(argv):
+    try:
+        opts, args = getopt.getopt(argv[1:], "ho:",
+                                   ["help", "latency=", "bandwidth=", "images=", "rounds=",
+                                    "output="])
+    except getopt.GetoptError as e:
+        print(e)
+        return 1
+
+    latency, bandwidth, images, rounds, output = 0.02, None, 20, 3, None
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            print(__doc__)
+            return 0
+        elif o == "--latency":
+            latency = float(a) / 1000
+        elif o == "--bandwidth":
+            bandwidth = float(a) * 1024
+        elif o == "--images":
+            images = int(a)
+        elif o == "--rounds":
+            rounds = int(a)
+        elif o in ("-o", "--output"):
+            output = os.path.abspath(a)
+
+    logging.basicConfig(level=logging.WARNING)
+    report = json.dumps(run(latency, bandwidth, images, rounds), indent=2)
+    if output:
+        with open(output, 'w') as f:
+            f.write(report + "\n")
+    else:
+        print(report)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
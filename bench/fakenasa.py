@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+''' Local stand-in for the parts of api.nasa.gov and mars.nasa.gov used
+by duna: rover manifests, paginated photo listings, the photos of the
+latest sol and the images.
+
+Images are synthetic JPEGs, generated from the file name so that every
+run serves the same bytes. Latency is added before every response, and
+response bodies are sent no faster than the bandwidth limit.
+'''
+
+import PIL.Image as Image
+
+import http.server
+import urllib.parse
+import threading
+import hashlib
+import random
+import json
+import io
+import sys
+import time
+import getopt
+import re
+
+# ------------------------------------------------------------------------------
+
+PAGE_SIZE = 25
+CHUNK_SIZE = 16 * 1024
+
+HAZCAMS = [
+    "FRONT_HAZCAM_LEFT_A",
+    "FRONT_HAZCAM_RIGHT_A",
+    "REAR_HAZCAM_LEFT",
+    "REAR_HAZCAM_RIGHT",
+]
+
+# Cameras and file names accepted by the filters in nasa.py
+ROVERS = {
+    "curiosity": {
+        "cameras": [ "NAVCAM" ] + HAZCAMS,
+        "name": "NLB_%04d%05d_%05dNCAM00%03dM_.JPG",
+    },
+    "perseverance": {
+        "cameras": [ "MCZ_LEFT" ] + HAZCAMS,
+        "name": "ZL0_%04d_%05d_%05dEBY_N0000000ZCAM%03d_1200.jpg",
+    },
+}
+
+
+def makeImage(name, size, quality=85):
+    ''' Return a JPEG of given size, always the same for the same name '''
+    rng = random.Random(hashlib.sha1(name.encode()).digest())
+    noise = Image.frombytes('L', (64, 48), bytes(rng.getrandbits(8) for i in range(64 * 48)))
+    img = noise.resize(size, Image.BICUBIC).convert('RGB')
+    out = io.BytesIO()
+    img.save(out, "JPEG", quality=quality)
+    return out.getvalue()
+
+
+class FakeNasa():
+    ''' FakeNasa(latency, bandwidth, imagesPerSol, imageSize, sols)
+    latency - seconds added before every response
+    bandwidth - bytes per second of each response body, or None for no limit
+    imagesPerSol - number of images of each camera at each sol
+    imageSize - (width, height) of the images
+    sols - number of sols in the manifests, the latest is sols - 1
+    '''
+
+    def __init__(self, latency=0.0, bandwidth=None, imagesPerSol=50,
+                 imageSize=(1024, 1024), sols=10):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.imagesPerSol = imagesPerSol
+        self.imageSize = imageSize
+        self.sols = sols
+        self.images = {}
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.bytesSent = 0
+        self.server = None
+
+
+    def start(self, port=0):
+        ''' Start serving on a background thread, return the base URL '''
+        fake = self
+
+        class Handler(RequestHandler):
+            server_version = "FakeNasa"
+            def getFake(self): return fake
+
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self.getBaseUrl()
+
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+    def getBaseUrl(self):
+        return "http://127.0.0.1:%d" % self.server.server_address[1]
+
+
+    def getStats(self):
+        with self.lock:
+            return { "requests": self.requests, "bytesSent": self.bytesSent }
+
+
+    def countResponse(self, size):
+        with self.lock:
+            self.requests += 1
+            self.bytesSent += size
+
+    # --------------------------------------------------------------------------
+
+    def getRoverManifest(self, rover):
+        return { "rover": { "name": rover, "max_sol": self.sols - 1 } }
+
+
+    def getPhotoManifest(self, rover):
+        cameras = ROVERS[rover]["cameras"]
+        return { "photo_manifest": {
+            "name": rover,
+            "max_sol": self.sols - 1,
+            "photos": list(map(lambda i: {
+                "sol": i,
+                "total_photos": self.imagesPerSol * len(cameras),
+                "cameras": cameras,
+            }, range(self.sols))),
+        }}
+
+
+    def listPhotos(self, rover, sol, camera, page=None):
+        cameras = [ camera ] if camera else ROVERS[rover]["cameras"]
+        photos = []
+        for c in cameras:
+            if c not in ROVERS[rover]["cameras"]: continue
+            for i in range(self.imagesPerSol):
+                n = ROVERS[rover]["name"] % (sol, ROVERS[rover]["cameras"].index(c), i, i)
+                photos.append({
+                    "id": len(photos),
+                    "sol": sol,
+                    "camera": { "name": c },
+                    "img_src": "%s/images/%s/%d/%s" % (self.getBaseUrl(), rover, sol, n),
+                })
+        if page is None: return photos
+        return photos[(page - 1) * PAGE_SIZE : page * PAGE_SIZE]
+
+
+    def getImage(self, name):
+        with self.lock:
+            data = self.images.get(name)
+        if data is None:
+            data = makeImage(name, self.imageSize)
+            with self.lock:
+                self.images[name] = data
+        return data
+
+
+class RequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    ROUTES = [
+        (re.compile('^/mars-photos/api/v1/rovers/([a-z]+)$'), "roverManifest"),
+        (re.compile('^/mars-photos/api/v1/manifests/([a-z]+)$'), "photoManifest"),
+        (re.compile('^/mars-photos/api/v1/rovers/([a-z]+)/photos$'), "photos"),
+        (re.compile('^/mars-photos/api/v1/rovers/([a-z]+)/latest_photos$'), "latestPhotos"),
+        (re.compile('^/images/([a-z]+)/([0-9]+)/([^/]+)$'), "image"),
+    ]
+
+    def do_GET(self):
+        fake = self.getFake()
+        time.sleep(fake.latency)
+
+        parts = urllib.parse.urlsplit(self.path)
+        query = dict(urllib.parse.parse_qsl(parts.query))
+        for (pattern, route) in self.ROUTES:
+            m = pattern.match(parts.path)
+            if m is None: continue
+            if m.group(1) not in ROVERS: break
+
+            if route == "roverManifest":
+                return self.sendJson(fake.getRoverManifest(m.group(1)))
+            elif route == "photoManifest":
+                return self.sendJson(fake.getPhotoManifest(m.group(1)))
+            elif route == "photos":
+                return self.sendJson({ "photos": fake.listPhotos(m.group(1),
+                                                                 int(query.get("sol", 0)),
+                                                                 query.get("camera"),
+                                                                 int(query.get("page", 1))) })
+            elif route == "latestPhotos":
+                return self.sendJson({ "latest_photos": fake.listPhotos(m.group(1),
+                                                                        fake.sols - 1, None) })
+            else:
+                return self.sendImage(fake.getImage(m.group(3)))
+
+        self.send_error(404)
+
+
+    def sendJson(self, body):
+        self.send("application/json", json.dumps(body).encode())
+
+
+    def sendImage(self, data):
+        etag = '"%s"' % hashlib.md5(data).hexdigest()
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send("image/jpeg", data, etag)
+
+
+    def send(self, contentType, data, etag=None):
+        fake = self.getFake()
+        self.send_response(200)
+        self.send_header("Content-Type", contentType)
+        self.send_header("Content-Length", str(len(data)))
+        if etag: self.send_header("ETag", etag)
+        self.end_headers()
+
+        start = time.monotonic()
+        for i in range(0, len(data), CHUNK_SIZE):
+            self.wfile.write(data[i : i + CHUNK_SIZE])
+            if fake.bandwidth:
+                # Sleep until the bytes sent so far fit in the bandwidth
+                ahead = (i + CHUNK_SIZE) / fake.bandwidth - (time.monotonic() - start)
+                if ahead > 0: time.sleep(ahead)
+        fake.countResponse(len(data))
+
+
+    def log_message(self, format, *args):
+        pass
+
+
+# ------------------------------------------------------------------------------
+
+def main(argv):
+    opts, args = getopt.getopt(argv[1:], "hp:",
+                               ["help", "port=", "latency=", "bandwidth=", "images=", "sols="])
+    port = 8000
+    fake = FakeNasa()
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            print("Usage:", argv[0], "[--port=8000] [--latency=<ms>] [--bandwidth=<kB/s>]",
+                  "[--images=<per camera and sol>] [--sols=<count>]")
+            return 0
+        elif o in ("-p", "--port"):
+            port = int(a)
+        elif o == "--latency":
+            fake.latency = float(a) / 1000
+        elif o == "--bandwidth":
+            fake.bandwidth = float(a) * 1024
+        elif o == "--images":
+            fake.imagesPerSol = int(a)
+        elif o == "--sols":
+            fake.sols = int(a)
+
+    print("Serving on", fake.start(port))
+    try:
+        while True: time.sleep(3600)
+    except KeyboardInterrupt:
+        fake.stop()
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -1,8 +1,9 @@
 #!/usr/bin/env python3
 
-import nasa
-import sync
-import display
+# Modules of the app are imported where they are first needed, so that
+# the first image is on the screen before requests, PIL and the web
+# engine are loaded
+import tracing
 
 import json
 import os
@@ -25,6 +26,7 @@ LOG_LEVELS = {
     "display": logging.DEBUG,
     "slideshow": logging.DEBUG,
     "panel": logging.DEBUG,
+    "sched": logging.DEBUG,
     "QT": logging.DEBUG,
 }
 
@@ -32,6 +34,30 @@ logger = logging.getLogger('main')
 
 # ------------------------------------------------------------------------------
 
+class StartupProfile():
+    ''' Time spent in each phase of the start, from the import of this module '''
+
+    def __init__(self):
+        self.phases = []
+        self.last = time.monotonic()
+
+
+    def mark(self, phase):
+        now = time.monotonic()
+        self.phases.append((phase, now - self.last))
+        self.last = now
+
+
+    def report(self):
+        for (phase, t) in self.phases:
+            print("%-20s %7.1f ms" % (phase, t * 1000))
+        print("%-20s %7.1f ms" % ("total", sum(map(lambda i: i[1], self.phases)) * 1000))
+
+
+startup = StartupProfile()
+
+# ------------------------------------------------------------------------------
+
 def minutes(m):
     return m * 60
 
@@ -48,6 +74,22 @@ SECONDS_IN = {
     'd': days(1),
 }
 
+BYTES_IN = {
+    'K': 1000,
+    'M': 1000 * 1000,
+    'G': 1000 * 1000 * 1000,
+}
+
+def parseSizeSpec(spec):
+    # if it's just a number, treat it as bytes
+    # Ex: "500M", "1.5G"
+    try: return int(spec)
+    except ValueError: pass
+
+    m = re.match('^([0-9.]+)[ ]*([KMG])B?$', spec.strip().upper())
+    if not m: raise ValueError("Invalid size: " + str(spec))
+    return int(float(m.group(1)) * BYTES_IN[m.group(2)])
+
 def parseTimeSpec(spec):
     # if it's just a number, treat it as seconds
     try: return int(spec)
@@ -67,10 +109,17 @@ def displayOutputFactory(cfg):
     interval = parseTimeSpec(cfg.get("interval") or "1m")
     updateInterval = parseTimeSpec(cfg.get("updateInterval") or "6h")
     firstUpdateDelay = parseTimeSpec(cfg.get("firstUpdateDelay") or "30s")
+    updateTimeout = parseTimeSpec(cfg.get("updateTimeout") or "30m")
+    prefetch = cfg.get("prefetch", 3)
+    cacheSize = cfg.get("imageCacheMB", 64) * 1024 * 1024
+    snapshotAge = parseTimeSpec(cfg.get("snapshotAge") or "1h")
 
+    import display
+    startup.mark("import display")
     return display.DisplayOutput(
         "Duna Screen v" + VER,
-        interval, updateInterval, firstUpdateDelay)
+        interval, updateInterval, firstUpdateDelay,
+        prefetch, cacheSize, updateTimeout, snapshotAge)
 
 def filesOutputFactory(config):
     import filesout
@@ -94,10 +143,14 @@ def staticChannelFactory(node, globalConfig, output):
     urls = node["urls"]
     updates = map(updaterFactory, node["updates"])
 
-    output.addStatic(urls, list(updates), sequenceLimit)
+    updateTimeout = parseTimeSpec(node.get("updateTimeout") or "0")
+
+    output.addStatic(urls, list(updates), sequenceLimit, updateTimeout)
 
 
 def makeUpdater(name, globalConfig):
+    import nasa
+    import sync
     if name.upper() == 'APOD':
         apiKey = globalConfig["apiKey"]
         return sync.ApodSync(nasa.ApodApi(apiKey), "slideshow")
@@ -107,12 +160,20 @@ def makeUpdater(name, globalConfig):
 
 
 def roverChannelFactory(node, globalConfig, output):
+    import nasa
     apiKey = globalConfig["apiKey"]
     sequenceLimit = node.get("sequenceLimit")
     api = nasa.makeApi(apiKey, validateRoverName(node["name"]))
     camera = node["camera"]
+    concurrency = node.get("concurrency")
+    imageLimit = node.get("imageLimit")
+    dashboards = node.get("dashboards")
+    backfillSols = node.get("backfillSols")
+    keepSols = node.get("keepSols")
+    updateTimeout = parseTimeSpec(node.get("updateTimeout") or "0")
 
-    output.addRover(api, camera, sequenceLimit)
+    output.addRover(api, camera, sequenceLimit, concurrency, imageLimit, dashboards,
+                    backfillSols, keepSols, updateTimeout)
 
 
 def validateRoverName(name):
@@ -136,7 +197,11 @@ class App():
         self.channelFactories = channelFactories
 
         self.output = self.buildOutputFromConfig(config)
+        startup.mark("first image")
+        setupSync(config)
+        startup.mark("sync setup")
         self.buildChannelsFromConfig(config)
+        startup.mark("channels")
         self.controlPanel = self.buildControlPanel(config)
 
 
@@ -173,7 +238,10 @@ class App():
             self.output.getSlideshow().nextImage()
         elif sig == signal.SIGUSR2:
             self.output.getSlideshow().prevImage()
+        elif sig == signal.SIGHUP:
+            tracing.toggle()
         else:
+            tracing.disable()
             self.output.kill()
 
 
@@ -188,16 +256,52 @@ class App():
 
 def main(argv):
     setupLogging()
-    sync.setup()
-
-    configFile, = parseCommandLine(argv)
+    configFile, recordDir, replayDir, speedup, startupProfile = parseCommandLine(argv)
     config = json.load(open(configFile or 'duna.json'))
-    app = App(config, outputFactories, channelFactories)
+    if config.get("trace"): tracing.enable()
+    startup.mark("config")
+
+    if recordDir:
+        import cassette
+        cassette.record(recordDir)
+    elif replayDir:
+        import cassette
+        import ratelimit
+        # The API is not used, only the replay speed limits the requests
+        ratelimit.REQUESTS_PER_HOUR = 1e9
+        ratelimit.BURST = 1e6
+        ratelimit.PAUSE_ON_QUOTA = False
+        cassette.replay(replayDir, speedup)
 
+    app = App(config, outputFactories, channelFactories)
     setupSignalHandler(app)
+    if startupProfile:
+        startup.report()
+        app.output.kill()
+        return
     app.main()
 
 
+def setupSync(config):
+    import sync
+    import nasa
+    import backfill
+    import storage
+    import metrics
+    import quality
+    sync.setup()
+    nasa.cache.prune()
+
+    backfill.budget.limit = config.get("backfillBudget")
+    storageConfig = config.get("storage", {})
+    storage.manager.budget = parseSizeSpec(storageConfig.get("budget", storage.BUDGET))
+    storage.manager.policy = storageConfig.get("policy", storage.OLDEST)
+    quality.imageFilter.configure(config.get("quality"))
+    metricsConfig = config.get("metrics")
+    if metricsConfig:
+        metrics.serve(metricsConfig.get("port", 9101), metricsConfig.get("address", ""))
+
+
 def setupLogging():
     logging.basicConfig(format="%(asctime)s [%(name)-10s] %(levelname)-7s %(message)s",
                         level=logging.ERROR, datefmt="%Y-%m-%d %H:%M:%S")
@@ -208,26 +312,41 @@ def setupLogging():
 def parseCommandLine(argv):
     try:
         opts, args = getopt.getopt(argv[1:], "hc:",
-                                   ["help", "config="])
+                                   ["help", "config=", "record=", "replay=", "speedup=",
+                                    "startup-profile"])
     except getopt.GetoptError as e:
         logger.exception("Parse command line", e)
         sys.exit(1)
 
     configFile = None
+    recordDir = None
+    replayDir = None
+    speedup = 1.0
+    startupProfile = False
     for o, a in opts:
         if o in ("-h", "--help"):
             printUsage()
             sys.exit()
         elif o in ("-c", "--config"):
             configFile = a
+        elif o == "--record":
+            recordDir = a
+        elif o == "--replay":
+            replayDir = a
+        elif o == "--speedup":
+            speedup = float(a)
+        elif o == "--startup-profile":
+            startupProfile = True
         else:
             assert False, "unhandled option"
 
-    return (configFile, )
+    return (configFile, recordDir, replayDir, speedup, startupProfile)
 
 
 def printUsage():
-    print("Usage:", sys.argv[0],"[--help] [--config=<config file>]")
+    print("Usage:", sys.argv[0],"[--help] [--config=<config file>]",
+          "[--record=<cassette dir> | --replay=<cassette dir> [--speedup=<factor>]]",
+          "[--startup-profile]")
 
 
 def setupSignalHandler(app):
@@ -235,6 +354,7 @@ def setupSignalHandler(app):
     signal.signal(signal.SIGTERM, app.onSignal)
     signal.signal(signal.SIGUSR1, app.onSignal)
     signal.signal(signal.SIGUSR1, app.onSignal)
+    signal.signal(signal.SIGHUP, app.onSignal)
 
 
 if __name__ == '__main__':
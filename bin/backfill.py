@@ -0,0 +1,121 @@
+import nasa
+import sched
+import threading
+import time
+import concurrent.futures
+import logging
+
+
+logger = logging.getLogger("sync")
+
+# ------------------------------------------------------------------------------
+
+class RequestBudget:
+    ''' The number of API requests backfills are allowed to make in one update,
+    shared by all channels. Only the requests made while syncing backfilled
+    sols are counted. Sols already being synced are allowed to finish
+    when the budget runs out; the remaining sols are left for the next update.
+    '''
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.counter = nasa.RequestCounter()
+
+
+    def reset(self):
+        self.counter = nasa.RequestCounter()
+
+
+    def getUsed(self):
+        return self.counter.get()
+
+
+    def isExhausted(self):
+        return self.limit is not None and self.getUsed() >= self.limit
+
+
+budget = RequestBudget(None)
+
+
+# ------------------------------------------------------------------------------
+
+
+class Backfill:
+    ''' Sync the sols of a rover that are missing locally, newest first.
+
+    makeSyncs(sol) returns the RoverSync objects for one sol. Sols are
+    considered within the last maxSols sols of the manifest; the ones
+    where none of the syncs has images, or all are already synced, are
+    skipped. Progress is recorded in the catalog as each sol completes,
+    so an interrupted backfill continues where it left off.
+    '''
+
+    def __init__(self, api, makeSyncs, maxSols, concurrency=2, budget=budget):
+        self.api = api
+        self.makeSyncs = makeSyncs
+        self.maxSols = maxSols
+        self.concurrency = concurrency
+        self.budget = budget
+        self.lock = threading.Lock()
+        self.done = 0
+        self.total = 0
+
+
+    def listMissing(self):
+        ''' Return a list of (sol, syncs) that still need syncing, newest first '''
+        lastSol = self.api.getLastSol()
+        missing = []
+        for entry in self.api.listSols(lastSol - self.maxSols + 1):
+            syncs = filter(lambda i: i.hasImagesIn(entry["cameras"]),
+                           self.makeSyncs(entry["sol"]))
+            syncs = list(filter(lambda i: not i.alreadySynced(), syncs))
+            if len(syncs) > 0:
+                missing.append((entry["sol"], syncs))
+        return missing
+
+
+    def run(self, deadline=None):
+        ''' Sync the missing sols, stopping at the deadline.
+        Returns a dict of sol -> list of new files '''
+        self.deadline = deadline or sched.Deadline()
+        missing = self.listMissing()
+        self.done = 0
+        self.total = len(missing)
+        if self.total == 0: return {}
+
+        logger.info("Backfill %s: %d sols missing: %s", self.api.ROVER, self.total,
+                    list(map(lambda i: i[0], missing)))
+        start = time.monotonic()
+        with concurrent.futures.ThreadPoolExecutor(self.concurrency) as pool:
+            results = pool.map(lambda i: self.syncSol(*i), missing)
+            newFiles = dict(filter(lambda i: i[1] is not None, results))
+
+        logger.info("Backfill %s: synced %d/%d sols in %.1fs, %d requests used",
+                    self.api.ROVER, len(newFiles), self.total,
+                    time.monotonic() - start, self.budget.getUsed())
+        return newFiles
+
+
+    def syncSol(self, sol, syncs):
+        if self.budget.isExhausted():
+            logger.debug("Backfill %s: request budget exhausted, skipping sol %d",
+                         self.api.ROVER, sol)
+            return (sol, None)
+        if self.deadline.isExpired():
+            return (sol, None)
+
+        files = []
+        for i in syncs:
+            try:
+                with nasa.countRequests(self.budget.counter):
+                    files.extend(i.sync(self.deadline) or [])
+            except sched.Cancelled:
+                return (sol, None)
+            except Exception:
+                logger.exception("Backfill %s: failed to sync sol %d", self.api.ROVER, sol)
+
+        with self.lock:
+            self.done += 1
+            logger.info("Backfill %s: %d/%d sols, sol %d: %d files",
+                        self.api.ROVER, self.done, self.total, sol, len(files))
+        return (sol, files)
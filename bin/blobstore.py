@@ -0,0 +1,98 @@
+import catalog
+import net
+import os
+import threading
+import logging
+
+
+logger = logging.getLogger("sync")
+
+# Downloaded files are stored once, as store/<2 hex digits>/<sha256>,
+# and hardlinked into the sync directories
+STORE_DIR = "store"
+
+lock = threading.Lock()
+
+# ------------------------------------------------------------------------------
+
+def getPath(digest):
+    return os.path.join(STORE_DIR, digest[:2], digest)
+
+
+def getEtag(headers):
+    ''' Return the strong ETag of a response, or None '''
+    etag = headers.get("ETag")
+    if etag is None or etag.startswith("W/"): return None
+    return etag
+
+
+def download(url, outDir, fileName=None):
+    ''' Download the URL like net.download() and add the file to the store.
+    If the server reports the ETag and size the URL had when its file was
+    stored, the stored file is linked instead of downloading the body.
+    Returns a (path, digest, bytes received, seconds) tuple.
+    '''
+    seen = {}
+
+    def lookup(headers):
+        seen["etag"] = getEtag(headers)
+        length = headers.get("Content-Length")
+        if seen["etag"] is None or length is None: return None
+        digest = catalog.db.findBlob(url, seen["etag"], int(length))
+        if digest is None or not os.path.exists(getPath(digest)): return None
+        seen["digest"] = digest
+        return getPath(digest)
+
+    path, size, t = net.download(url, outDir, fileName, lookup=lookup)
+    digest = seen.get("digest")
+    if digest is None or not os.path.exists(getPath(digest)) or \
+       not os.path.samefile(path, getPath(digest)):
+        digest = add(path, url, seen.get("etag"))
+    return (path, digest, size, t)
+
+
+def add(path, url=None, etag=None):
+    ''' Add the file to the store, leaving a hardlink at path. If a file with
+    the same content is already stored, path is replaced by a link to it.
+    Returns the digest of the content. '''
+    digest = catalog.checksum(path)
+    blob = getPath(digest)
+    with lock:
+        if os.path.exists(blob):
+            if not os.path.samefile(blob, path):
+                logger.debug("%s is a duplicate of %s", path, blob)
+                net.link(blob, path)
+        else:
+            net.mkdir(os.path.dirname(blob))
+            try:
+                os.link(path, blob)
+            except OSError as e:
+                logger.warning("Cannot store %s: %s", path, e)
+                return digest
+        catalog.db.addBlob(digest, os.path.getsize(blob), url, etag)
+    return digest
+
+
+def gc():
+    ''' Delete stored files that are no longer linked from any sync directory.
+    Returns the number of bytes freed. '''
+    if not os.path.isdir(STORE_DIR): return 0
+    freed = 0
+    with lock:
+        for d in os.listdir(STORE_DIR):
+            for digest in os.listdir(os.path.join(STORE_DIR, d)):
+                blob = os.path.join(STORE_DIR, d, digest)
+                st = os.stat(blob)
+                if st.st_nlink > 1: continue
+                os.unlink(blob)
+                catalog.db.removeBlob(digest)
+                freed += st.st_size
+    if freed > 0:
+        logger.debug("Removed %d bytes of unused files from the store", freed)
+    return freed
+
+
+def getShare(st):
+    ''' Return the part of the size of a file attributed to one of its links,
+    not counting the link in the store '''
+    return st.st_size / max(1, st.st_nlink - 1)
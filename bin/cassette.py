@@ -0,0 +1,166 @@
+import net
+import requests
+import requests.structures
+import json
+import io
+import os
+import hashlib
+import threading
+import time
+import urllib.parse
+import logging
+
+
+logger = logging.getLogger("sync")
+
+# Response headers kept in a cassette
+HEADERS = [ "Content-Type", "Content-Length", "ETag", "Last-Modified",
+            "X-RateLimit-Remaining" ]
+
+# ------------------------------------------------------------------------------
+
+def getKey(request):
+    ''' Return the key of a request in a cassette: the method and the URL,
+    without the API key '''
+    parts = urllib.parse.urlsplit(request.url)
+    query = filter(lambda i: i[0] != 'api_key', urllib.parse.parse_qsl(parts.query))
+    url = urllib.parse.urlunsplit(parts._replace(query=urllib.parse.urlencode(list(query))))
+    return request.method + " " + url
+
+
+class Cassette:
+    ''' Recorded HTTP responses, stored in a directory: index.json maps
+    request keys to the status, headers and duration of the response,
+    and the bodies are stored once each under bodies/, named by their
+    SHA-1.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.bodiesDir = os.path.join(path, "bodies")
+        self.indexPath = os.path.join(path, "index.json")
+        self.lock = threading.Lock()
+        self.entries = {}
+        if os.path.exists(self.indexPath):
+            with open(self.indexPath) as f:
+                self.entries = json.load(f)
+
+
+    def lookup(self, key):
+        with self.lock:
+            return self.entries.get(key)
+
+
+    def getBody(self, entry):
+        with open(os.path.join(self.bodiesDir, entry["body"]), 'rb') as f:
+            return f.read()
+
+
+    def record(self, key, status, headers, body, seconds):
+        digest = hashlib.sha1(body).hexdigest()
+        net.mkdir(self.bodiesDir)
+        bodyPath = os.path.join(self.bodiesDir, digest)
+        if not os.path.exists(bodyPath):
+            with open(bodyPath + ".tmp", 'wb') as f:
+                f.write(body)
+            os.replace(bodyPath + ".tmp", bodyPath)
+
+        with self.lock:
+            self.entries[key] = {
+                "status": status,
+                "headers": dict(filter(lambda i: i[0] in HEADERS, headers.items())),
+                "body": digest,
+                "seconds": seconds,
+            }
+            tmp = self.indexPath + ".tmp"
+            with open(tmp, 'w') as f:
+                json.dump(self.entries, f, indent=1, sort_keys=True)
+            os.replace(tmp, self.indexPath)
+
+
+# ------------------------------------------------------------------------------
+
+
+class RecordingAdapter(requests.adapters.HTTPAdapter):
+    ''' Sends requests over the network and records the responses.
+    Conditional and range headers are dropped, so that every response
+    is recorded in full. '''
+
+    DROPPED_HEADERS = [ "If-None-Match", "If-Modified-Since", "Range" ]
+
+    def __init__(self, cassette):
+        super().__init__(pool_connections=1, pool_maxsize=16)
+        self.cassette = cassette
+
+
+    def send(self, request, **kwargs):
+        for i in self.DROPPED_HEADERS:
+            request.headers.pop(i, None)
+        start = time.monotonic()
+        response = super().send(request, **kwargs)
+        body = response.content
+        self.cassette.record(getKey(request), response.status_code,
+                             response.headers, body, time.monotonic() - start)
+        return response
+
+
+class ReplayAdapter(requests.adapters.BaseAdapter):
+    ''' Answers requests from a cassette, without the network. Each response
+    takes its recorded time divided by speedup; a speedup of 0 returns
+    responses at once. Requests that are not in the cassette get a 404.
+    '''
+
+    def __init__(self, cassette, speedup=1.0):
+        super().__init__()
+        self.cassette = cassette
+        self.speedup = speedup
+
+
+    def send(self, request, **kwargs):
+        key = getKey(request)
+        entry = self.cassette.lookup(key)
+        if entry is None:
+            logger.warning("Not in the cassette: %s", key)
+            return self.makeResponse(request, 404, {}, b'')
+
+        if self.speedup:
+            time.sleep(entry["seconds"] / self.speedup)
+
+        etag = entry["headers"].get("ETag")
+        if etag is not None and request.headers.get("If-None-Match") == etag:
+            return self.makeResponse(request, 304, { "ETag": etag }, b'')
+        # Range requests get the whole file, as from a server without ranges
+        return self.makeResponse(request, entry["status"], entry["headers"],
+                                 self.cassette.getBody(entry))
+
+
+    def makeResponse(self, request, status, headers, body):
+        r = requests.Response()
+        r.status_code = status
+        r.headers = requests.structures.CaseInsensitiveDict(headers)
+        r.raw = io.BytesIO(body)
+        r.url = request.url
+        r.request = request
+        r.connection = self
+        return r
+
+
+    def close(self):
+        pass
+
+
+# ------------------------------------------------------------------------------
+
+def record(path):
+    ''' Record all HTTP traffic from now on into the cassette at path '''
+    cassette = Cassette(path)
+    net.setAdapterFactory(lambda: RecordingAdapter(cassette))
+    logger.info("Recording HTTP responses into %s", path)
+
+
+def replay(path, speedup=1.0):
+    ''' Answer all HTTP requests from now on from the cassette at path '''
+    cassette = Cassette(path)
+    net.setAdapterFactory(lambda: ReplayAdapter(cassette, speedup))
+    logger.info("Replaying HTTP responses from %s, %d recorded, speed-up %s",
+                path, len(cassette.entries), speedup)
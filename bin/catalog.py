@@ -0,0 +1,328 @@
+import sqlite3
+import hashlib
+import os
+import re
+import time
+import threading
+import logging
+
+
+logger = logging.getLogger("sync")
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS syncs (
+    rover TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    sol INTEGER NOT NULL,
+    dir TEXT NOT NULL,
+    synced_at REAL NOT NULL,
+    displayed_at REAL,
+    empty INTEGER,
+    evicted INTEGER,
+    PRIMARY KEY (rover, kind, sol)
+);
+
+CREATE TABLE IF NOT EXISTS images (
+    path TEXT PRIMARY KEY,
+    rover TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    sol INTEGER NOT NULL,
+    camera TEXT,
+    url TEXT,
+    size INTEGER,
+    checksum TEXT,
+    created_at REAL NOT NULL,
+    modified_at REAL,
+    low_quality INTEGER,
+    dhash INTEGER,
+    duplicate INTEGER,
+    repeats_sol INTEGER
+);
+
+CREATE TABLE IF NOT EXISTS blobs (
+    digest TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    created_at REAL NOT NULL
+);
+
+-- The URL each stored file was downloaded from, with the ETag it had then
+CREATE TABLE IF NOT EXISTS blob_urls (
+    url TEXT PRIMARY KEY,
+    digest TEXT NOT NULL,
+    etag TEXT NOT NULL,
+    size INTEGER NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS images_by_sol ON images (rover, kind, sol);
+CREATE INDEX IF NOT EXISTS images_by_url ON images (url);
+CREATE INDEX IF NOT EXISTS syncs_by_dir ON syncs (dir);
+CREATE INDEX IF NOT EXISTS blob_urls_by_digest ON blob_urls (digest);
+DROP INDEX IF EXISTS blobs_by_etag;
+'''
+
+# Columns added after the first version of the schema: (table, column, type)
+ADDED_COLUMNS = [
+    ("syncs", "displayed_at", "REAL"),
+    ("syncs", "empty", "INTEGER"),
+    ("syncs", "evicted", "INTEGER"),
+    ("images", "low_quality", "INTEGER"),
+    ("images", "dhash", "INTEGER"),
+    ("images", "duplicate", "INTEGER"),
+    ("images", "repeats_sol", "INTEGER"),
+]
+
+# Kind of the images synced by RoverCameraSync; dashboards use their name
+CAMERA = "camera"
+
+# Sync directory names: <rover>-<sol> or <rover>-<dashboard>-<sol>
+SYNC_DIR_PATTERN = re.compile('^([a-z0-9]+)-(?:([A-Za-z0-9_]+)-)?([0-9]+)$')
+
+# ------------------------------------------------------------------------------
+
+def checksum(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(64 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def isImageFile(fileName):
+    n = fileName.lower()
+    return n.endswith('.jpg') or n.endswith('.jpeg') or n.endswith('.png')
+
+
+class Catalog:
+    ''' Index of synced sols and images, stored in SQLite.
+    The connection is shared by all threads, guarded by a lock.
+    '''
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.addColumns()
+        self.db.executescript(SCHEMA)
+
+
+    def addColumns(self):
+        for (table, column, columnType) in ADDED_COLUMNS:
+            columns = self.db.execute('PRAGMA table_info(%s)' % table).fetchall()
+            if len(columns) > 0 and column not in map(lambda i: i[1], columns):
+                self.db.execute('ALTER TABLE %s ADD COLUMN %s %s' % (table, column, columnType))
+
+
+    def query(self, sql, args=()):
+        with self.lock:
+            return self.db.execute(sql, args).fetchall()
+
+
+    def update(self, sql, args=()):
+        with self.lock, self.db:
+            self.db.execute(sql, args)
+
+
+    def addImage(self, rover, kind, sol, path, camera=None, url=None, digest=None):
+        ''' Record an image file that has been synced.
+        digest is the checksum of the file, if already known '''
+        st = os.stat(path)
+        self.update('INSERT OR REPLACE INTO images '
+                    '(path, rover, kind, sol, camera, url, size, checksum, created_at, modified_at) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (path, rover, kind, sol, camera, url, st.st_size,
+                     digest or checksum(path), time.time(), st.st_mtime))
+
+
+    def findByUrl(self, url):
+        ''' Return the path of an image synced from given URL, or None '''
+        r = self.query('SELECT path FROM images WHERE url = ?', (url,))
+        return r[0][0] if r else None
+
+
+    def addBlob(self, digest, size, url=None, etag=None):
+        ''' Record a stored file, and the URL and ETag it was downloaded from '''
+        with self.lock, self.db:
+            self.db.execute('INSERT OR IGNORE INTO blobs (digest, size, created_at) '
+                            'VALUES (?, ?, ?)', (digest, size, time.time()))
+            if url is not None and etag is not None:
+                self.db.execute('INSERT OR REPLACE INTO blob_urls (url, digest, etag, size) '
+                                'VALUES (?, ?, ?, ?)', (url, digest, etag, size))
+
+
+    def findBlob(self, url, etag, size):
+        ''' Return the digest of the stored file downloaded from the URL when
+        it had given ETag and size, or None. An ETag only identifies one
+        version of one resource, so it is never matched across URLs. '''
+        r = self.query('SELECT digest FROM blob_urls WHERE url = ? AND etag = ? AND size = ?',
+                       (url, etag, size))
+        return r[0][0] if r else None
+
+
+    def removeBlob(self, digest):
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM blobs WHERE digest = ?', (digest,))
+            self.db.execute('DELETE FROM blob_urls WHERE digest = ?', (digest,))
+
+
+    def markSynced(self, rover, kind, sol, syncDir, empty=False):
+        ''' Record the sol as synced. An empty sol had no images to sync;
+        it is not synced again, but not listed among the latest sols. '''
+        self.update('INSERT OR REPLACE INTO syncs (rover, kind, sol, dir, synced_at, empty) '
+                    'VALUES (?, ?, ?, ?, ?, ?)',
+                    (rover, kind, sol, syncDir, time.time(), int(empty)))
+
+
+    def markDisplayed(self, syncDir):
+        self.update('UPDATE syncs SET displayed_at = ? WHERE dir = ?', (time.time(), syncDir))
+
+
+    def listSyncs(self):
+        ''' Return (rover, kind, sol, dir, synced_at, displayed_at) of all synced sols '''
+        return self.query('SELECT rover, kind, sol, dir, synced_at, displayed_at FROM syncs')
+
+
+    def removeSol(self, rover, sol):
+        ''' Forget the images synced for the sol, and record it as evicted.
+        An evicted sol is not synced again, but not listed among the
+        latest sols. '''
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM images WHERE rover = ? AND sol = ?', (rover, sol))
+            self.db.execute('UPDATE syncs SET evicted = 1 WHERE rover = ? AND sol = ?',
+                            (rover, sol))
+
+
+    def forgetSync(self, rover, kind, sol):
+        ''' Forget a sync whose directory was deleted from the disk, such as
+        by limit_disk_usage.sh, so that the sol is synced again '''
+        logger.info("Sync directory of %s %s sol %d is gone, forgetting it", rover, kind, sol)
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM images WHERE rover = ? AND kind = ? AND sol = ?',
+                            (rover, kind, sol))
+            self.db.execute('DELETE FROM syncs WHERE rover = ? AND kind = ? AND sol = ?',
+                            (rover, kind, sol))
+
+
+    def isSynced(self, rover, kind, sol):
+        r = self.query('SELECT dir, empty, evicted FROM syncs '
+                       'WHERE rover = ? AND kind = ? AND sol = ?', (rover, kind, sol))
+        if len(r) == 0: return False
+        syncDir, empty, evicted = r[0]
+        if empty or evicted or os.path.isdir(syncDir): return True
+        self.forgetSync(rover, kind, sol)
+        return False
+
+
+    def getLatestSol(self, rover, kind):
+        ''' Return the latest sol synced whose directory still exists, or None '''
+        while True:
+            r = self.query('SELECT sol, dir FROM syncs WHERE rover = ? AND kind = ? '
+                           'AND NOT COALESCE(empty, 0) AND NOT COALESCE(evicted, 0) '
+                           'ORDER BY sol DESC LIMIT 1', (rover, kind))
+            if len(r) == 0: return None
+            sol, syncDir = r[0]
+            if os.path.isdir(syncDir): return sol
+            self.forgetSync(rover, kind, sol)
+
+
+    def listLatestSols(self, rover, count):
+        ''' Return the latest count sols with anything synced, newest first '''
+        r = self.query('SELECT DISTINCT sol FROM syncs WHERE rover = ? '
+                       'AND NOT COALESCE(empty, 0) AND NOT COALESCE(evicted, 0) '
+                       'ORDER BY sol DESC LIMIT ?', (rover, count))
+        return list(map(lambda i: i[0], r))
+
+
+    def listImages(self, rover, kind, sol):
+        ''' Return paths of the images synced at given sol '''
+        r = self.query('SELECT path FROM images WHERE rover = ? AND kind = ? AND sol = ? '
+                       'ORDER BY path', (rover, kind, sol))
+        return list(map(lambda i: i[0], r))
+
+
+    def setQuality(self, results):
+        ''' Record (path, low quality, hash, duplicate, repeated sol) of scored
+        images. A duplicate repeats another image of its sol; the repeated sol,
+        or None, is the other sol with an image it repeats.
+        The 64-bit hashes are stored as signed integers. '''
+        toSigned = lambda h: h - (1 << 64) if h >= (1 << 63) else h
+        with self.lock, self.db:
+            self.db.executemany('UPDATE images SET low_quality = ?, dhash = ?, duplicate = ?, '
+                                'repeats_sol = ? WHERE path = ?',
+                                map(lambda i: (int(i[1]), toSigned(i[2]), int(i[3]), i[4], i[0]),
+                                    results))
+
+
+    def listQuality(self, rover, kind, sol):
+        ''' Return (low quality paths, near duplicate paths) of the images
+        synced at given sol, as sets. Near duplicates include the images
+        repeating another sol. '''
+        r = self.query('SELECT path, low_quality, duplicate OR repeats_sol IS NOT NULL '
+                       'FROM images WHERE rover = ? AND kind = ? AND sol = ?',
+                       (rover, kind, sol))
+        return (set(map(lambda i: i[0], filter(lambda i: i[1], r))),
+                set(map(lambda i: i[0], filter(lambda i: i[2], r))))
+
+
+    def listHashes(self, rover, kind, sols, limit):
+        ''' Return (sol, hash) of the images of the sols that are shown:
+        not low quality, not duplicates and not repeating another sol '''
+        if len(sols) == 0: return []
+        r = self.query('SELECT sol, dhash FROM images WHERE rover = ? AND kind = ? '
+                       'AND sol IN (%s) AND dhash IS NOT NULL AND NOT low_quality '
+                       'AND NOT duplicate AND repeats_sol IS NULL LIMIT ?'
+                       % ",".join("?" * len(sols)),
+                       (rover, kind) + tuple(sols) + (limit,))
+        return list(map(lambda i: (i[0], i[1] & 0xFFFFFFFFFFFFFFFF), r))
+
+
+    def releaseRepeats(self, rover, kind, sols):
+        ''' Forget that images of the sols repeat other sols that are not
+        among them, so they are shown again. Returns (sol, path, low quality)
+        of these images. '''
+        if len(sols) == 0: return []
+        marks = ",".join("?" * len(sols))
+        args = (rover, kind) + tuple(sols) + tuple(sols)
+        where = ('WHERE rover = ? AND kind = ? AND sol IN (%s) AND repeats_sol IS NOT NULL '
+                 'AND repeats_sol NOT IN (%s)' % (marks, marks))
+        with self.lock, self.db:
+            r = self.db.execute('SELECT sol, path, low_quality FROM images ' + where +
+                                ' ORDER BY path',
+                                args).fetchall()
+            self.db.execute('UPDATE images SET repeats_sol = NULL ' + where, args)
+        return r
+
+
+    def isEmpty(self):
+        return len(self.query('SELECT 1 FROM syncs LIMIT 1')) == 0
+
+
+    def importDirs(self, baseDir):
+        ''' Record sync directories created before the catalog existed '''
+        for d in sorted(os.listdir(baseDir)):
+            m = SYNC_DIR_PATTERN.match(d)
+            if not m: continue
+
+            rover, kind, sol = m.group(1), m.group(2) or CAMERA, int(m.group(3))
+            syncDir = os.path.join(baseDir, d)
+            logger.info("Importing %s into the catalog", syncDir)
+            images = filter(isImageFile, sorted(os.listdir(syncDir)))
+            if kind != CAMERA:
+                # Only the composite of a dashboard is shown, not the tiles
+                images = filter(lambda i: i.startswith("dash-"), images)
+            for i in images:
+                self.addImage(rover, kind, sol, os.path.join(syncDir, i))
+            self.markSynced(rover, kind, sol, syncDir)
+
+
+# ------------------------------------------------------------------------------
+
+db = None
+
+def init(path, baseDir):
+    ''' Open the catalog, importing existing sync directories on first use '''
+    global db
+    db = Catalog(path)
+    if db.isEmpty():
+        db.importDirs(baseDir)
+    return db
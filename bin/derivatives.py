@@ -0,0 +1,62 @@
+import metrics
+import imgload
+import os
+import logging
+
+
+logger = logging.getLogger("sync")
+
+# Derivatives are kept in this subdirectory, next to the originals
+DERIVATIVES_DIR = "display"
+QUALITY = 85
+
+makeTime = metrics.histogram("duna_derivative_seconds", "Time to decode, scale and save "
+                             "a display derivative")
+
+# ------------------------------------------------------------------------------
+
+def getPath(original):
+    ''' Return the path of the display derivative of given original image '''
+    d, n = os.path.split(original)
+    return os.path.join(d, DERIVATIVES_DIR, os.path.splitext(n)[0] + ".jpg")
+
+
+def isUpToDate(original, derivative):
+    return os.path.exists(derivative) and \
+        os.path.getmtime(derivative) >= os.path.getmtime(original)
+
+
+def make(original, size):
+    ''' Return the path of a JPEG copy of the original image that fits
+    in size (width, height). The copy is only created if it is missing
+    or older than the original.
+    '''
+    path = getPath(original)
+    if isUpToDate(original, path): return path
+
+    with makeTime.time():
+        img = imgload.load(original, size)
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = path + ".tmp"
+        img.save(tmp, "JPEG", quality=QUALITY)
+        os.replace(tmp, path)
+
+    logger.debug("Created %s", path)
+    return path
+
+
+def makeAll(originals, size, pool=None):
+    ''' Return derivatives of all the originals, creating the missing ones,
+    optionally in parallel on the given executor.
+    If a derivative cannot be created, the original is used instead. '''
+    mapper = pool.map if pool else map
+    return list(mapper(lambda i: tryMake(i, size), originals))
+
+
+def tryMake(original, size):
+    try:
+        return make(original, size)
+    except Exception:
+        logger.exception("Failed to create derivative of %s", original)
+        return original
@@ -1,43 +1,158 @@
-import sync
+import catalog
 import slideshow
 import sched
+import metrics
+import tracing
 import qtviews
+import threading
+import time
 import logging
 
 logger = logging.getLogger("display")
 
+def importSyncModules():
+    ''' The sync modules pull in requests and PIL, which take long to load.
+    They are imported once the first image is on the screen. '''
+    global sync, backfill, storage, quality
+    import sync
+    import backfill
+    import storage
+    import quality
+
+
+updateTime = metrics.histogram("duna_channel_update_seconds",
+                               "Time to update a channel, by channel and status")
+
 class DisplayOutput():
-    def __init__(self, title, interval, updateInterval, firstUpdateDelay):
+    def __init__(self, title, interval, updateInterval, firstUpdateDelay,
+                 prefetchCount=0, cacheSize=None, updateTimeout=None, snapshotAge=None):
         qtviews.init([])
         self.channels = []
+        self.webUrls = []
+        self.updateTimeout = updateTimeout
+        self.updateTimeouts = {}
+        self.updating = {}
+        self.updateLock = threading.Lock()
         self.root = slideshow.SlideshowChannels()
-        self.viewer = qtviews.UniversalViewer(title)
+        self.viewer = qtviews.UniversalViewer(title, prefetchCount, cacheSize, snapshotAge)
+        self.viewer.showLast()
         self.scheduler = sched.Scheduler()
+        metrics.gauge("duna_scheduler_lag_seconds", "Delay of the last run of a task",
+                      lambda: map(lambda i: ({ "task": i["name"] }, i["lag"]),
+                                  self.scheduler.getStats()))
+        metrics.counter("duna_scheduler_missed_runs_total", "Runs of a task skipped so far",
+                        lambda: map(lambda i: ({ "task": i["name"] }, i["missed"]),
+                                    self.scheduler.getStats()))
 
         self.scheduler.runPeriodically(interval, self.nextImage)
         self.scheduler.runPeriodically(updateInterval, self.update)
         self.scheduler.runAfter(firstUpdateDelay, self.update)
+        self.snapshotAge = snapshotAge
 
 
-    def addRover(self, api, camera, sequenceLimit):
-        ch = RoverDisplayChannel(self.viewer, api, camera)
-        self.channels.append(ch)
-        self.root.add(ch.slideshow, sequenceLimit)
+    def addRover(self, api, camera, sequenceLimit, concurrency=None, imageLimit=None,
+                 dashboards=None, backfillSols=None, keepSols=None, updateTimeout=None):
+        importSyncModules()
+        ch = RoverDisplayChannel(self.viewer, api, camera, concurrency, imageLimit,
+                                 dashboards, backfillSols, keepSols,
+                                 qtviews.getScreenSize())
+        self.addChannel(ch, sequenceLimit, updateTimeout)
 
 
-    def addStatic(self, urls, updates, sequenceLimit):
+    def addStatic(self, urls, updates, sequenceLimit, updateTimeout=None):
         ch = StaticDisplayChannel(self.viewer, urls, updates)
+        webUrls = list(filter(qtviews.isWebUrl, urls))
+        if len(webUrls) > 0 and len(self.webUrls) == 0:
+            self.enableWeb()
+        self.webUrls.extend(webUrls)
+        self.addChannel(ch, sequenceLimit, updateTimeout)
+
+
+    def addChannel(self, ch, sequenceLimit, updateTimeout):
+        importSyncModules()
         self.channels.append(ch)
+        self.updateTimeouts[ch] = updateTimeout or self.updateTimeout
         self.root.add(ch.slideshow, sequenceLimit)
 
 
+    @tracing.traced("DisplayOutput.update")
     def update(self):
+        ''' Update all channels in parallel, each on its own thread and with
+        its own deadline. Waits until every channel has finished or passed
+        its deadline, and returns a list of (channel, status, seconds).
+        A channel whose previous update is still running is skipped.
+        '''
+        importSyncModules()
+        backfill.budget.reset()
+        started = []
+        statuses = {}
         for i in self.channels:
-            logger.info("Update %s", i)
-            try:
-                i.update()
-            except Exception:
-                logger.exception("Error updating %s", i)
+            with self.updateLock:
+                if i in self.updating:
+                    logger.warning("Previous update of %s still running, skipping", i)
+                    continue
+                deadline = sched.Deadline(self.updateTimeouts[i])
+                self.updating[i] = deadline
+
+            t = threading.Thread(target=self.updateChannel, args=(i, deadline, statuses),
+                                 name="update " + str(i), daemon=True)
+            t.start()
+            started.append((i, deadline, t, time.monotonic()))
+
+        report = []
+        for (i, deadline, t, start) in started:
+            t.join(deadline.getRemaining())
+            if t.is_alive():
+                deadline.cancel()
+                statuses[i] = ("timed out", time.monotonic() - start)
+            report.append((i,) + statuses[i])
+
+        for (i, status, elapsed) in report:
+            logger.info("Update report: %s: %s in %.1fs", i, status, elapsed)
+
+        storage.manager.enforce(self.isProtected)
+        return report
+
+
+    def isProtected(self, rover, sol):
+        ''' Sols in a slideshow, and all sols of a rover whose update is
+        still running, are not evicted from the disk '''
+        with self.updateLock:
+            updating = set(self.updating.keys())
+        return any(map(lambda i: i.isProtected(rover, sol, i in updating), self.channels))
+
+
+    @tracing.traced("DisplayOutput.updateChannel",
+                    lambda self, channel, deadline, statuses: { "channel": str(channel) })
+    def updateChannel(self, channel, deadline, statuses):
+        logger.info("Update %s", channel)
+        start = time.monotonic()
+        status = "failed"
+        try:
+            channel.update(deadline)
+            status = "ok"
+        except sched.Cancelled:
+            logger.warning("Update of %s cancelled at its deadline", channel)
+            status = "cancelled"
+        except Exception:
+            logger.exception("Error updating %s", channel)
+        finally:
+            updateTime.observe(time.monotonic() - start, channel=str(channel), status=status)
+            statuses.setdefault(channel, (status, time.monotonic() - start))
+            with self.updateLock:
+                del self.updating[channel]
+
+
+    def enableWeb(self):
+        self.viewer.enableWeb()
+        if self.snapshotAge:
+            # Refreshed well before they expire, so pages are rarely loaded live
+            self.scheduler.runAfter(0, self.refreshSnapshots)
+            self.scheduler.runPeriodically(self.snapshotAge / 2, self.refreshSnapshots)
+
+
+    def refreshSnapshots(self):
+        self.viewer.refreshSnapshots(self.webUrls)
 
 
     def getSlideshow(self):
@@ -63,31 +178,123 @@ class DisplayOutput():
 
 
 class RoverDisplayChannel():
-    def __init__(self, viewer, api, camera):
+    ''' Images from one rover camera, plus composite dashboards.
+    dashboards - list of { "name", "layout", "tileSize" } dicts,
+                 or None for the hazcam dashboard
+    backfillSols - number of recent sols to sync if missing, or None to
+                   only sync the latest sol
+    keepSols - number of the latest sols kept in the slideshow
+    '''
+
+    def __init__(self, viewer, api, camera, concurrency=None, imageLimit=None,
+                 dashboards=None, backfillSols=None, keepSols=None, displaySize=None):
         self.api = api
         self.slideshow = slideshow.Slideshow(viewer)
         self.camera = camera
+        self.concurrency = concurrency
+        self.imageLimit = imageLimit
+        self.dashboards = dashboards
+        self.backfillSols = backfillSols
+        self.keepSols = keepSols or 1
+        self.displaySize = displaySize
 
-        for i in [ sync.RoverCameraSync, sync.RoverHazcamSync ]:
-            tmp = i.listLatestImages(api)
-            if tmp: self.slideshow.add(tmp)
+        self.slideshow.addShowListener(self.onShow)
 
+        # sol -> files of the sols in the slideshow
+        self.sols = {}
+        sols = catalog.db.listLatestSols(api.ROVER, self.keepSols)
+        self.merge(dict(map(lambda i: (i, self.listSolImages(i)), sols)))
 
-    def update(self):
-        newFiles = []
+
+    def listSolImages(self, sol):
+        files = sync.RoverCameraSync.listSolImages(self.api, sol, self.displaySize)
+        for i in self.listDashboardNames():
+            tmp = sync.RoverDashboardSync.listSolImages(self.api, i, sol, self.displaySize)
+            if tmp: files.append(tmp)
+        return files
+
+
+    def merge(self, newFiles):
+        ''' Add new files, given as a dict of sol -> files, to the slideshow
+        and drop the sols that no longer fit in the retention limit '''
+        for sol, files in newFiles.items():
+            self.sols.setdefault(sol, [])
+            self.sols[sol].extend(filter(lambda i: i not in self.sols[sol], files))
+
+        keep = sorted(self.sols.keys())[-self.keepSols:]
+        removed = []
+        for sol in list(self.sols.keys()):
+            if sol not in keep:
+                removed.extend(self.sols.pop(sol))
+
+        added = []
+        for sol in sorted(newFiles.keys()):
+            if sol in keep: added.extend(newFiles[sol])
+
+        # Images repeating a sol that is no longer shown take its place
+        for sol, path, low in catalog.db.releaseRepeats(self.api.ROVER, catalog.CAMERA, keep):
+            files = quality.imageFilter.arrange([ path ], { path } if low else set(), set())
+            files = sync.makeDisplayImages(files, self.displaySize)
+            self.sols[sol].extend(files)
+            added.extend(files)
+
+        logger.debug("%s: %d files added, %d removed, sols %s", self,
+                     len(added), len(removed), keep)
+        self.slideshow.merge(added, removed)
+
+
+    def listShownSols(self, sol):
+        ''' Return the other sols that stay in the slideshow with given sol '''
+        keep = sorted(set(self.sols.keys()) | { sol })[-self.keepSols:]
+        if sol not in keep: return []
+        return list(filter(lambda i: i != sol, keep))
+
+
+    def onShow(self, img):
+        catalog.db.markDisplayed(storage.getSyncDir(img))
+
+
+    def isProtected(self, rover, sol, updating):
+        return rover == self.api.ROVER and (updating or sol in self.sols)
+
+
+    def listDashboardNames(self):
+        if self.dashboards is None: return [ sync.RoverHazcamSync.NAME ]
+        return list(map(lambda i: i["name"], self.dashboards))
+
+
+    def makeSyncs(self, sol):
+        ''' Return the sync actions of this channel for given sol,
+        or for the latest sol if None '''
         actions = [
-            sync.RoverCameraSync(self.api, sol=None, camera=self.camera),
-            sync.RoverHazcamSync(self.api, sol=None),
+            sync.RoverCameraSync(self.api, sol=sol, camera=self.camera,
+                                 concurrency=self.concurrency,
+                                 limit=self.imageLimit,
+                                 displaySize=self.displaySize,
+                                 listShownSols=self.listShownSols),
         ]
 
-        for i in actions:
-            newFiles.extend(i.sync() or [])
+        if self.dashboards is None:
+            return actions + [ sync.RoverHazcamSync(self.api, sol, displaySize=self.displaySize) ]
+
+        return actions + list(map(lambda i: sync.RoverDashboardSync(
+            self.api, sol, i["name"], i["layout"], i["tileSize"], self.displaySize),
+                                  self.dashboards))
+
+
+    def update(self, deadline=None):
+        deadline = deadline or sched.Deadline()
+        newFiles = {}
+        for i in self.makeSyncs(None):
+            files = i.sync(deadline)
+            if files: newFiles.setdefault(i.sol, []).extend(files)
 
-        logger.debug("New files after sync: %d", len(newFiles))
+        logger.debug("New files after sync: %d", sum(map(len, newFiles.values())))
+        self.merge(newFiles)
 
-        if len(newFiles) > 0:
-            self.slideshow.clear()
-            self.slideshow.add(newFiles)
+        if self.backfillSols:
+            newFiles = backfill.Backfill(self.api, self.makeSyncs, self.backfillSols).run(deadline)
+            self.merge(newFiles)
 
 
     def __str__(self):
@@ -104,9 +311,15 @@ class StaticDisplayChannel:
         self.updates = updates
 
 
-    def update(self):
+    def update(self, deadline=None):
+        deadline = deadline or sched.Deadline()
         for i in self.updates:
-            i.sync()
+            deadline.check()
+            i.sync(deadline)
+
+
+    def isProtected(self, rover, sol, updating):
+        return False
 
     def __str__(self):
         return "Slideshow channel"
@@ -10,12 +10,15 @@ class FilesOutput:
         self.slideshow = FehSlideshow()
 
 
-    def addRover(self, api, camera, sequenceLimit):
-        self.updaters.append(sync.RoverCameraSync(api, sol=None, camera=camera))
+    def addRover(self, api, camera, sequenceLimit, concurrency=None, imageLimit=None,
+                 dashboards=None, backfillSols=None, keepSols=None, updateTimeout=None):
+        self.updaters.append(sync.RoverCameraSync(api, sol=None, camera=camera,
+                                                  concurrency=concurrency,
+                                                  limit=imageLimit))
         self.updaters.append(sync.RoverHazcamSync(self.api, sol=None))
 
 
-    def addStatic(self, urls, updates, sequenceLimit):
+    def addStatic(self, urls, updates, sequenceLimit, updateTimeout=None):
         self.updaters.extend(updates)
 
 
@@ -0,0 +1,60 @@
+import math
+
+
+# JPEG decoders can scale by 1/2, 1/4 and 1/8 while decoding
+MAX_REDUCTION = 8
+
+# Modes PIL can reduce; others, e.g. palette, 1-bit and 16-bit images,
+# are converted to RGB first
+REDUCIBLE_MODES = ("L", "LA", "RGB", "RGBA")
+
+# ------------------------------------------------------------------------------
+
+def fitSize(size, box):
+    ''' Return size (width, height) scaled to fit in box, keeping the aspect
+    ratio. Sizes smaller than the box are returned as they are. '''
+    w, h = size
+    scale = min(1.0, box[0] / w, box[1] / h)
+    return (max(1, round(w * scale)), max(1, round(h * scale)))
+
+
+def getReduction(size, target):
+    ''' Return the largest power of two, up to MAX_REDUCTION, by which an
+    image of size can be reduced and still be at least as large as target '''
+    factor = 1
+    while factor < MAX_REDUCTION and \
+          math.ceil(size[0] / (factor * 2)) >= target[0] and \
+          math.ceil(size[1] / (factor * 2)) >= target[1]:
+        factor *= 2
+    return factor
+
+
+def getReducedSize(size, factor):
+    ''' Return the size a JPEG decoder produces when reducing by factor '''
+    return (math.ceil(size[0] / factor), math.ceil(size[1] / factor))
+
+
+def load(path, size, fit=True, resample=None):
+    ''' Return the image at path as RGB, scaled to size (width, height).
+    With fit, it is scaled to fit in size keeping the aspect ratio, and not
+    enlarged; otherwise it is stretched to size.
+    JPEGs are decoded directly at the reduced scale closest to the target,
+    other formats are reduced by an integer factor before resampling.
+    '''
+    # PIL is only loaded when the first image is made, not at start
+    import PIL.Image as Image
+    if resample is None: resample = Image.BICUBIC
+
+    with Image.open(path) as img:
+        target = fitSize(img.size, size) if fit else tuple(size)
+        factor = getReduction(img.size, target)
+        if img.format == "JPEG":
+            img.draft('RGB', getReducedSize(img.size, factor))
+        elif factor > 1:
+            if img.mode not in REDUCIBLE_MODES: img = img.convert('RGB')
+            img = img.reduce(factor)
+        img = img.convert('RGB')
+
+    if img.size != target:
+        img = img.resize(target, resample)
+    return img
@@ -0,0 +1,211 @@
+import resource
+import http.server
+import threading
+import time
+import os
+import logging
+
+
+logger = logging.getLogger("main")
+
+# Upper bounds of histogram buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 1800)
+
+# ------------------------------------------------------------------------------
+
+def getKey(labels):
+    return tuple(sorted(map(lambda i: (i[0], str(i[1])), labels.items())))
+
+
+def formatLabels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if len(pairs) == 0: return ""
+    escape = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return "{" + ",".join(map(lambda i: '%s="%s"' % (i[0], escape(i[1])), pairs)) + "}"
+
+
+def formatValue(v):
+    if v == float("inf"): return "+Inf"
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+
+class Metric:
+    ''' A named value, with one instance per combination of label values
+    given as keyword arguments. If fn is given, it is called when the
+    metrics are read, and returns a list of (labels dict, value). '''
+
+    TYPE = "untyped"
+
+    def __init__(self, name, help, fn=None):
+        self.name = name
+        self.help = help
+        self.fn = fn
+        self.values = {}
+        self.lock = threading.Lock()
+
+
+    def collect(self):
+        ''' Return a list of (key, value) of all label combinations '''
+        if self.fn is not None:
+            return list(map(lambda i: (getKey(i[0]), i[1]), self.fn()))
+        with self.lock:
+            return list(self.values.items())
+
+
+    def render(self):
+        lines = [ "# HELP %s %s" % (self.name, self.help),
+                  "# TYPE %s %s" % (self.name, self.TYPE) ]
+        for (key, value) in sorted(self.collect()):
+            lines.append("%s%s %s" % (self.name, formatLabels(key), formatValue(value)))
+        return lines
+
+
+class Counter(Metric):
+    TYPE = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = getKey(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    ''' A value that goes up and down '''
+
+    TYPE = "gauge"
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[getKey(labels)] = value
+
+
+class Histogram(Metric):
+    TYPE = "histogram"
+
+    def __init__(self, name, help, buckets=BUCKETS):
+        super().__init__(name, help)
+        self.buckets = tuple(buckets) + (float("inf"),)
+
+
+    def observe(self, value, **labels):
+        key = getKey(labels)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * len(self.buckets), 0.0))
+            counts = list(counts)
+            for i in range(len(self.buckets)):
+                if value <= self.buckets[i]: counts[i] += 1
+            self.values[key] = (counts, total + value)
+
+
+    def time(self, **labels):
+        ''' Return a context manager observing the time spent in it '''
+        return Timer(self, labels)
+
+
+    def render(self):
+        lines = [ "# HELP %s %s" % (self.name, self.help),
+                  "# TYPE %s %s" % (self.name, self.TYPE) ]
+        for (key, (counts, total)) in sorted(self.collect()):
+            for (le, n) in zip(self.buckets, counts):
+                lines.append("%s_bucket%s %d" % (self.name,
+                                                 formatLabels(key, [("le", formatValue(le))]), n))
+            lines.append("%s_sum%s %s" % (self.name, formatLabels(key), repr(total)))
+            lines.append("%s_count%s %d" % (self.name, formatLabels(key), counts[-1]))
+        return lines
+
+
+class Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, *args):
+        self.histogram.observe(time.monotonic() - self.start, **self.labels)
+
+
+# ------------------------------------------------------------------------------
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+
+    def register(self, metric):
+        ''' Add the metric, or return the one registered under its name '''
+        with self.lock:
+            return self.metrics.setdefault(metric.name, metric)
+
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for i in metrics:
+            try:
+                lines.extend(i.render())
+            except Exception:
+                logger.exception("Failed to collect metric %s", i.name)
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+def counter(name, help, fn=None):
+    return registry.register(Counter(name, help, fn))
+
+def gauge(name, help, fn=None):
+    return registry.register(Gauge(name, help, fn))
+
+def histogram(name, help, buckets=BUCKETS):
+    return registry.register(Histogram(name, help, buckets))
+
+
+# ------------------------------------------------------------------------------
+
+def getResidentBytes():
+    ''' Return the resident set size of the process '''
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        # Peak rather than current size, in kB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+gauge("duna_process_resident_bytes", "Resident memory of the process",
+      lambda: [ ({}, getResidentBytes()) ])
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = registry.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def log_message(self, format, *args):
+        pass
+
+
+server = None
+
+def serve(port, address=""):
+    ''' Serve the metrics at http://<address>:<port>/metrics on a background thread '''
+    global server
+    server = http.server.ThreadingHTTPServer((address, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info("Serving metrics on port %d", port)
+    return server
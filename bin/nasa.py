@@ -1,10 +1,33 @@
+import net
+import ratelimit
+import metrics
+import tracing
 import requests
+import json
+import os
+import time
+import hashlib
+import threading
+import contextlib
+import contextvars
+import concurrent.futures
+import urllib.parse
+import logging
+
+
+logger = logging.getLogger("sync")
 
 
 def getFileName(url):
     return url.split('/')[-1]
 
 
+def stripApiKey(url):
+    parts = urllib.parse.urlsplit(url)
+    query = filter(lambda i: i[0] != 'api_key', urllib.parse.parse_qsl(parts.query))
+    return urllib.parse.urlunsplit(parts._replace(query=urllib.parse.urlencode(list(query))))
+
+
 def makeApi(apiKey, name):
     if name == CuriosityApi.ROVER:
         return CuriosityApi(apiKey)
@@ -19,25 +42,208 @@ def makeApi(apiKey, name):
 # ------------------------------------------------------------------------------
 
 
+class ResponseCache:
+    ''' Persistent cache of JSON responses, keyed by the URL with the API key
+    stripped. Each entry keeps the validators (ETag, Last-Modified) needed
+    to revalidate it with a conditional GET once it expires.
+    '''
+
+    MAX_AGE = 7 * 24 * 60 * 60
+
+    def __init__(self, cacheDir):
+        self.cacheDir = cacheDir
+        self.entries = {}
+        self.lock = threading.Lock()
+
+
+    def getPath(self, url):
+        key = hashlib.sha1(stripApiKey(url).encode()).hexdigest()
+        return os.path.join(self.cacheDir, key + ".json")
+
+
+    def lookup(self, url):
+        path = self.getPath(url)
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is None and os.path.exists(path):
+                try:
+                    with open(path) as f:
+                        entry = json.load(f)
+                    self.entries[path] = entry
+                except ValueError:
+                    logger.warning("Discarding corrupt cache entry %s", path)
+            return entry
+
+
+    def store(self, url, entry):
+        path = self.getPath(url)
+        with self.lock:
+            self.entries[path] = entry
+            net.mkdir(self.cacheDir)
+            tmp = path + ".tmp"
+            with open(tmp, 'w') as f:
+                json.dump(entry, f)
+            os.replace(tmp, path)
+
+
+    def prune(self, maxAge=None):
+        ''' Remove entries that have not been fetched or revalidated recently '''
+        if not os.path.isdir(self.cacheDir): return
+        limit = time.time() - (maxAge or self.MAX_AGE)
+        with self.lock:
+            for i in os.listdir(self.cacheDir):
+                path = os.path.join(self.cacheDir, i)
+                if os.path.getmtime(path) < limit:
+                    os.unlink(path)
+                    self.entries.pop(path, None)
+
+
+cache = ResponseCache("cache/api")
+
+# Background fetching of the next page of paginated listings
+prefetcher = concurrent.futures.ThreadPoolExecutor(2)
+
+# Number of requests sent to the API, not counting cache hits
+requestCount = 0
+requestCountLock = threading.Lock()
+
+requestTime = metrics.histogram("duna_api_request_seconds", "Time of an API request")
+cacheResults = metrics.counter("duna_api_cache_total", "API responses from the cache, "
+                               "revalidated or fetched")
+
+# Counter of the requests made in the current context, see countRequests
+currentCounter = contextvars.ContextVar("currentCounter", default=None)
+
+class RequestCounter:
+    def __init__(self):
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def inc(self):
+        with self.lock:
+            self.count += 1
+
+    def get(self):
+        with self.lock:
+            return self.count
+
+
+@contextlib.contextmanager
+def countRequests(counter):
+    ''' Count the requests made within the context with the counter,
+    including pages prefetched for them in the background '''
+    token = currentCounter.set(counter)
+    try:
+        yield counter
+    finally:
+        currentCounter.reset(token)
+
+
+def countRequest():
+    global requestCount
+    with requestCountLock:
+        requestCount += 1
+    counter = currentCounter.get()
+    if counter is not None: counter.inc()
+
+def getRequestCount():
+    with requestCountLock:
+        return requestCount
+
+
+# ------------------------------------------------------------------------------
+
+
 class NasaApi:
     BASE_URL = "https://api.nasa.gov"
 
-    def __init__(self, apiKey):
+    # How long a cached response is used without asking the server, in seconds
+    DEFAULT_TTL = 5 * 60
+
+    def __init__(self, apiKey, cache=cache):
         self.apiKey = apiKey
+        self.cache = cache
+        self.limiter = ratelimit.getLimiter(apiKey)
 
 
     def buildUrl(self, path):
         return self.BASE_URL + path + '?api_key=' + self.apiKey
 
 
-    def get(self, url):
+    @tracing.traced("NasaApi.get", lambda self, url, ttl=None: { "url": stripApiKey(url) })
+    def get(self, url, ttl=None):
         ''' Perform a GET request to the specified URL
         and return the response as JSON or raise an exception
         in case of failure.
+        A cached response younger than ttl seconds is returned without
+        a request; an older one is revalidated with a conditional GET.
         '''
-        response = requests.get(url)
+        ttl = self.DEFAULT_TTL if ttl is None else ttl
+        entry = self.cache.lookup(url)
+        if entry and time.time() - entry["fetched"] < ttl:
+            cacheResults.inc(result="hit")
+            return entry["body"]
+
+        headers = {}
+        if entry and entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry and entry.get("lastModified"):
+            headers["If-Modified-Since"] = entry["lastModified"]
+
+        response = self.send(url, headers)
+        if response.status_code == 304 and entry:
+            logger.debug("Not modified: %s", stripApiKey(url))
+            cacheResults.inc(result="revalidated")
+            entry["fetched"] = time.time()
+            self.cache.store(url, entry)
+            return entry["body"]
+
         response.raise_for_status()
-        return response.json()
+        cacheResults.inc(result="fetched")
+        body = response.json()
+        self.cache.store(url, {
+            "url": stripApiKey(url),
+            "fetched": time.time(),
+            "etag": response.headers.get("ETag"),
+            "lastModified": response.headers.get("Last-Modified"),
+            "body": body,
+        })
+        return body
+
+
+    def send(self, url, headers):
+        ''' Send the request within the rate limit of the API key, retrying
+        with backoff on connection errors, 429 and server errors '''
+        for attempt in range(ratelimit.RETRIES + 1):
+            self.limiter.acquire()
+            countRequest()
+            try:
+                with requestTime.time():
+                    response = net.getSession(url).get(url, headers=headers, timeout=net.TIMEOUT)
+                net.responses.inc(kind="api", status=response.status_code)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                net.responses.inc(kind="api", status="error")
+                if attempt == ratelimit.RETRIES: raise
+                delay = ratelimit.getRetryDelay(attempt)
+                logger.warning("Request failed (%s), retrying in %.1fs", e, delay)
+                time.sleep(delay)
+                continue
+
+            remaining = response.headers.get("X-RateLimit-Remaining")
+            if remaining is not None and remaining.isdigit():
+                self.limiter.setRemaining(int(remaining))
+
+            retryAfter = response.headers.get("Retry-After")
+            if response.status_code == 429 and retryAfter is not None and retryAfter.isdigit():
+                self.limiter.setRetryAfter(int(retryAfter))
+
+            if not ratelimit.isRetryable(response.status_code) or attempt == ratelimit.RETRIES:
+                return response
+
+            delay = ratelimit.getRetryDelay(attempt, retryAfter)
+            logger.warning("Request failed with %d, retrying in %.1fs",
+                           response.status_code, delay)
+            time.sleep(delay)
 
 
 # ------------------------------------------------------------------------------
@@ -47,6 +253,7 @@ class ApodApi(NasaApi):
     ''' Astronomy Picture Of the Day Endpoint '''
 
     PATH = "/planetary/apod"
+    TTL = 60 * 60
 
     def __init__(self, apiKey):
         super().__init__(apiKey)
@@ -55,51 +262,260 @@ class ApodApi(NasaApi):
     def getLatestImage(self):
         ''' Return the URL of the latest APOD image '''
         url = self.buildUrl(self.PATH)
-        r = self.get(url)
+        r = self.get(url, self.TTL)
         return  (r["media_type"], r["url"])
 
 
 # ------------------------------------------------------------------------------
 
 
+class RoverManifest:
+    ''' The photo manifest of a rover, indexed by sol, and kept in a file so
+    that it is not downloaded again at every start. Each entry is a dict
+    with "sol", "total_photos" and "cameras".
+
+    The whole manifest, thousands of sols, is fetched once a day with
+    a conditional GET. In between, only the entry of the latest sol is
+    updated, from the photos of the latest sol.
+    '''
+
+    FULL_REFRESH = 24 * 60 * 60
+
+    def __init__(self, api, path):
+        self.api = api
+        self.path = path
+        self.lock = threading.Lock()
+        self.loaded = False
+        self.sols = {}
+        self.maxSol = None
+        self.checked = 0
+        self.fetched = 0
+        self.etag = None
+        self.lastModified = None
+
+
+    def getMaxSol(self):
+        with self.lock:
+            self.refresh()
+            return self.maxSol
+
+
+    def get(self, sol):
+        ''' Return the entry of the sol, or None if it has no photos '''
+        with self.lock:
+            self.refresh()
+            return self.sols.get(sol)
+
+
+    def listSols(self, fromSol=0):
+        ''' Return the entries of sols since fromSol, newest first '''
+        with self.lock:
+            self.refresh()
+            sols = map(self.sols.get, range(self.maxSol, max(fromSol, 0) - 1, -1))
+            return list(filter(None, sols))
+
+
+    def refresh(self):
+        ''' Update the index if it was not checked within the TTL. If that
+        fails, the one from the file is used. '''
+        if not self.loaded: self.load()
+        now = time.time()
+        if now - self.checked < self.api.MANIFEST_TTL: return
+        try:
+            if self.maxSol is None or now - self.fetched >= self.FULL_REFRESH:
+                self.fetchAll()
+            else:
+                self.fetchLatest()
+        except (requests.RequestException, ValueError, KeyError) as e:
+            if self.maxSol is None: raise
+            logger.warning("Failed to update the %s manifest, using the one from %s: %s",
+                           self.api.ROVER, time.ctime(self.checked), e)
+            return
+        self.checked = now
+        try:
+            self.save()
+        except OSError as e:
+            logger.warning("Failed to save the %s manifest: %s", self.api.ROVER, e)
+
+
+    def fetchAll(self):
+        headers = {}
+        if self.etag: headers["If-None-Match"] = self.etag
+        if self.lastModified: headers["If-Modified-Since"] = self.lastModified
+
+        response = self.api.send(self.api.photoManifestUrl, headers)
+        if response.status_code == 304 and self.maxSol is not None:
+            logger.debug("The %s manifest is not modified", self.api.ROVER)
+            cacheResults.inc(result="revalidated")
+        else:
+            response.raise_for_status()
+            cacheResults.inc(result="fetched")
+            manifest = response.json()["photo_manifest"]
+            self.sols = dict(map(lambda i: (i["sol"], i), manifest["photos"]))
+            self.maxSol = int(manifest["max_sol"])
+            self.etag = response.headers.get("ETag")
+            self.lastModified = response.headers.get("Last-Modified")
+            logger.debug("Fetched the %s manifest: %d sols, latest %d",
+                         self.api.ROVER, len(self.sols), self.maxSol)
+        self.fetched = time.time()
+
+
+    def fetchLatest(self):
+        photos = self.api.get(self.api.latestPhotosUrl, 0)["latest_photos"]
+        if len(photos) == 0: return
+        sol = photos[0]["sol"]
+        if sol > self.maxSol + 1:
+            # Sols were missed since the last update
+            self.fetchAll()
+            return
+
+        self.sols[sol] = {
+            "sol": sol,
+            "earth_date": photos[0].get("earth_date"),
+            "total_photos": len(photos),
+            "cameras": sorted(set(map(lambda i: i["camera"]["name"], photos))),
+        }
+        self.maxSol = max(self.maxSol, sol)
+
+
+    def load(self):
+        self.loaded = True
+        if not os.path.exists(self.path): return
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+            self.sols = dict(map(lambda i: (i["sol"], i), data["photos"]))
+            self.maxSol = data["maxSol"]
+            self.checked = data["checked"]
+            self.fetched = data["fetched"]
+            self.etag = data.get("etag")
+            self.lastModified = data.get("lastModified")
+        except (ValueError, KeyError):
+            logger.warning("Discarding corrupt manifest %s", self.path)
+            self.sols = {}
+            self.maxSol = None
+
+
+    def save(self):
+        net.mkdir(os.path.dirname(self.path))
+        tmp = self.path + ".tmp"
+        with open(tmp, 'w') as f:
+            json.dump({
+                "maxSol": self.maxSol,
+                "checked": self.checked,
+                "fetched": self.fetched,
+                "etag": self.etag,
+                "lastModified": self.lastModified,
+                "photos": list(map(self.sols.get, sorted(self.sols.keys()))),
+            }, f)
+        os.replace(tmp, self.path)
+
+
+manifests = {}
+manifestsLock = threading.Lock()
+
+def getManifest(api, path):
+    ''' Return the manifest shared by all APIs of the rover '''
+    with manifestsLock:
+        m = manifests.get(api.ROVER)
+        if m is None:
+            m = RoverManifest(api, path)
+            manifests[api.ROVER] = m
+        return m
+
+
 class RoverApi(NasaApi):
     ''' Rover Images Endpoint '''
 
+    # Listings of past sols rarely change, the manifest changes daily
+    MANIFEST_TTL = 15 * 60
+    IMAGES_TTL = 60 * 60
+
+    # Number of photos per page of the photos listing
+    PAGE_SIZE = 25
+
+    MANIFEST_DIR = "cache/manifests"
+
     def __init__(self, apiKey, rover):
         super().__init__(apiKey)
-        self.manifestUrl = self.buildUrl("/mars-photos/api/v1/rovers/" + rover)
+        self.photoManifestUrl = self.buildUrl("/mars-photos/api/v1/manifests/" + rover)
+        self.latestPhotosUrl = self.buildUrl("/mars-photos/api/v1/rovers/" + rover +
+                                             "/latest_photos")
         self.imagesUrl = self.buildUrl("/mars-photos/api/v1/rovers/" + rover + "/photos")
+        self.manifest = getManifest(self, os.path.join(self.MANIFEST_DIR, rover + ".json"))
 
 
     def getLastSol(self):
         ''' Return the latest available sol numer '''
-        return int(self.get(self.manifestUrl)["rover"]["max_sol"])
+        return self.manifest.getMaxSol()
+
+
+    def listSols(self, fromSol=0):
+        ''' Return manifest entries of sols since fromSol, newest first '''
+        return self.manifest.listSols(fromSol)
 
 
     def listCameras(self, sol):
         ''' Return a list of cameras that provided images at given sol '''
-        manifest = self.get(self.manifestUrl)
-        solManifest = self.findSolManifest(manifest, sol)
+        solManifest = self.findSolManifest(sol)
         if solManifest:
             return solManifest["cameras"]
         else:
             return None
 
 
-    def findSolManifest(self, manifest, sol):
-        for i in manifest["photo_manifest"]["photos"]:
-            if i["sol"] == sol:
-                return i
-        return None
+    def findSolManifest(self, sol):
+        return self.manifest.get(sol)
 
 
-    def listImages(self, sol, camera=None):
-        ''' Return a list of URLs to images from given camera at given sol '''
+    def listImages(self, sol, camera=None, accept=None, limit=None, prefetch=True):
+        ''' Return a generator of (URL, camera) tuples for images from given
+        camera at given sol.
+        accept - optional predicate, images it rejects are skipped
+        limit - stop after this many accepted images, or None for all
+        prefetch - fetch the next page in the background while the current
+                   one is being consumed
+        Pages are only requested as the generator is consumed.
+        '''
         url = self.imagesUrl + "&sol=" + str(sol)
         if camera:
             url += "&camera=" + camera
-        response = self.get(url)
-        return map(lambda i: (i["img_src"], i["camera"]["name"]), response["photos"])
+
+        if limit is not None and limit <= 0: return
+        n = 0
+        # The next page is not prefetched if this one may reach the limit
+        wantNext = lambda photos: prefetch and (limit is None or n + len(photos) < limit)
+        for page in self.listPages(url, wantNext):
+            for i in page:
+                img = (i["img_src"], i["camera"]["name"])
+                if accept and not accept(img): continue
+                n += 1
+                yield img
+                if n == limit: return
+
+
+    def listPages(self, url, prefetch):
+        ''' Return a generator of pages of the listing. The next page is
+        fetched in the background if prefetch(photos of this page) is true '''
+        page = 1
+        pending = None
+        while True:
+            photos = pending.result() if pending else self.getPage(url, page)
+            pending = None
+            if len(photos) == 0: return
+
+            lastPage = len(photos) < self.PAGE_SIZE
+            if not lastPage and prefetch(photos):
+                pending = prefetcher.submit(contextvars.copy_context().run,
+                                            self.getPage, url, page + 1)
+
+            yield photos
+            if lastPage: return
+            page += 1
+
+
+    def getPage(self, url, page):
+        return self.get(url + "&page=" + str(page), self.IMAGES_TTL)["photos"]
 
 
     def wantImage(self, url):
@@ -0,0 +1,179 @@
+import metrics
+import requests
+import os
+import shutil
+import time
+import threading
+import urllib.parse
+import logging
+
+
+logger = logging.getLogger("sync")
+
+CHUNK_SIZE = 64 * 1024
+TIMEOUT = (10, 60)
+
+# Number of times an interrupted download is resumed before giving up
+RETRIES = 3
+RETRY_DELAY = 2
+
+downloadedBytes = metrics.counter("duna_download_bytes_total", "Bytes downloaded")
+downloadTime = metrics.histogram("duna_download_seconds", "Time to download a file")
+responses = metrics.counter("duna_http_responses_total", "HTTP responses by kind and status")
+
+# ------------------------------------------------------------------------------
+
+def getFileName(url):
+    return url.split('/')[-1]
+
+
+def mkdir(path):
+    if not os.path.isdir(path): os.makedirs(path)
+
+
+def getHost(url):
+    return urllib.parse.urlsplit(url).netloc
+
+
+def makeAdapter():
+    return requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=16)
+
+# Creates the transport of new sessions, replaced to record or replay traffic
+adapterFactory = makeAdapter
+
+sessions = {}
+sessionsLock = threading.Lock()
+
+def getSession(url):
+    ''' Return a keep-alive session shared by all requests to the host of
+    the given URL. '''
+    host = getHost(url)
+    with sessionsLock:
+        s = sessions.get(host)
+        if s is None:
+            s = requests.Session()
+            adapter = adapterFactory()
+            s.mount('http://', adapter)
+            s.mount('https://', adapter)
+            sessions[host] = s
+        return s
+
+
+class IncompleteDownload(IOError):
+    pass
+
+
+def download(url, outDir, fileName=None, retries=RETRIES, lookup=None):
+    ''' Download the URL into outDir over the shared session for its host.
+    Returns a (path, bytes received, seconds) tuple or raises an exception.
+
+    The data is written to a .part file which is renamed to the final name
+    only once complete. An interrupted transfer, in this call or one made
+    by an earlier run, is resumed with a Range request.
+
+    lookup(headers), if given, is called with the headers of a response
+    carrying the whole file, and returns the path of a local file with the
+    same content, or None. A local file found this way is linked to the
+    output path and the body is not downloaded.
+    '''
+    path = os.path.join(outDir, fileName or getFileName(url))
+    part = path + ".part"
+    start = time.monotonic()
+    # Bytes written by all attempts, including the interrupted ones
+    progress = { "received": 0 }
+    for attempt in range(retries + 1):
+        try:
+            downloadPart(url, part, lookup, progress)
+            break
+        except (requests.ConnectionError, requests.Timeout,
+                requests.exceptions.ChunkedEncodingError, IncompleteDownload) as e:
+            if attempt == retries:
+                downloadedBytes.inc(progress["received"])
+                raise
+            logger.warning("Download of %s interrupted, resuming: %s", url, e)
+            time.sleep(RETRY_DELAY * (attempt + 1))
+
+    os.replace(part, path)
+    elapsed = time.monotonic() - start
+    size = progress["received"]
+    downloadedBytes.inc(size)
+    downloadTime.observe(elapsed)
+    return (path, size, elapsed)
+
+
+def downloadPart(url, part, lookup=None, progress=None):
+    ''' Fetch the remainder of the URL into the part file.
+    progress["received"], if given, is increased by every chunk written,
+    so it counts the bytes of an attempt that fails half way. '''
+    progress = progress if progress is not None else { "received": 0 }
+    offset = os.path.getsize(part) if os.path.exists(part) else 0
+    headers = { "Accept-Encoding": "identity" }
+    if offset > 0:
+        headers["Range"] = "bytes=%d-" % offset
+
+    with getSession(url).get(url, headers=headers, stream=True, timeout=TIMEOUT) as r:
+        responses.inc(kind="download", status=r.status_code)
+        if r.status_code == 416:
+            # The part file does not match the remote file, start over
+            logger.debug("Discarding %s", part)
+            os.unlink(part)
+            return downloadPart(url, part, lookup, progress)
+
+        r.raise_for_status()
+        contentRange = r.headers.get("Content-Range", "")
+        if r.status_code != 206 or not contentRange.startswith("bytes %d-" % offset):
+            # The server sent the whole file
+            offset = 0
+            copy = lookup(r.headers) if lookup else None
+            if copy is not None and tryLink(copy, part):
+                logger.debug("%s is already in %s", url, copy)
+                return
+
+        length = r.headers.get("Content-Length")
+        expected = offset + int(length) if length is not None else None
+        if offset > 0:
+            logger.debug("Resuming %s at %d bytes", url, offset)
+
+        received = 0
+        with open(part, 'ab' if offset > 0 else 'wb') as f:
+            for chunk in r.iter_content(CHUNK_SIZE):
+                f.write(chunk)
+                received += len(chunk)
+                progress["received"] += len(chunk)
+
+    if expected is not None and offset + received != expected:
+        raise IncompleteDownload("Received %d of %d bytes" % (offset + received, expected))
+
+
+def link(src, dst):
+    ''' Replace dst with a hardlink to src, or with a copy of src if the
+    file system does not support hardlinks '''
+    tmp = dst + ".link"
+    if os.path.lexists(tmp): os.unlink(tmp)
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copyfile(src, tmp)
+    os.replace(tmp, dst)
+
+
+def tryLink(src, dst):
+    try:
+        link(src, dst)
+        return True
+    except OSError as e:
+        # The file may have been removed in the meantime
+        logger.debug("Failed to link %s: %s", src, e)
+        return False
+
+
+def setAdapterFactory(factory):
+    ''' Use the factory for the transport of all sessions from now on '''
+    global adapterFactory
+    with sessionsLock:
+        adapterFactory = factory
+        sessions.clear()
+
+
+def formatRate(size, seconds):
+    return "%.1f kB/s" % (size / 1024 / max(seconds, 0.001))
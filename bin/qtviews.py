@@ -1,11 +1,15 @@
 from PyQt5 import QtWidgets, QtGui, QtCore
 
-try:
-    from PyQt5.QtWebEngineWidgets import *
-    QWebView = QWebEngineView
-except ModuleNotFoundError:
-    from PyQt5.QtWebKitWidgets import *
-
+import metrics
+import tracing
+import imgload
+import os
+import collections
+import concurrent.futures
+import hashlib
+import threading
+import queue
+import time
 import logging
 
 # ------------------------------------------------------------------------------
@@ -14,6 +18,26 @@ logger = logging.getLogger("QT")
 
 activeView = None
 
+QWebView = None
+
+def importWebView():
+    ''' Return the web view class. The web engine takes long to load, so it
+    is only imported when there are web pages to show. '''
+    global QWebView
+    if QWebView is None:
+        try:
+            from PyQt5.QtWebEngineWidgets import QWebEngineView
+            QWebView = QWebEngineView
+        except ModuleNotFoundError:
+            from PyQt5.QtWebKitWidgets import QWebView as QWebKitView
+            QWebView = QWebKitView
+    return QWebView
+
+decodeTime = metrics.histogram("duna_image_decode_seconds", "Time to decode and scale "
+                               "an image for the screen")
+cacheRequests = metrics.counter("duna_image_cache_total", "Images requested from the "
+                                "decoded image cache, by hit or miss")
+
 class Signal(QtCore.QObject):
     sig = QtCore.pyqtSignal(str)
 
@@ -25,10 +49,145 @@ class Signal(QtCore.QObject):
         self.sig.emit(arg)
 
 
+class ImageCache():
+    ''' LRU cache of decoded images, already scaled to the screen size.
+
+    Images listed with prefetch() are loaded by a background thread, which
+    is possible because QImage, unlike QPixmap, can be used outside of the
+    GUI thread. Entries are keyed by path and modification time, so a file
+    that is overwritten in place gets loaded again. An image requested while
+    it is being loaded is waited for instead of being loaded twice.
+    '''
+
+    def __init__(self, width, height, maxBytes):
+        self.width = width
+        self.height = height
+        self.maxBytes = maxBytes
+        self.entries = collections.OrderedDict()
+        self.loading = {}
+        self.totalBytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.pending = queue.Queue()
+        threading.Thread(target=self.worker, daemon=True).start()
+        metrics.gauge("duna_image_cache_bytes", "Size of the decoded image cache",
+                      lambda: [ ({}, self.totalBytes) ])
+
+
+    def get(self, path):
+        ''' Return the scaled image, loading it now if it is not cached '''
+        key = self.makeKey(path)
+        with self.lock:
+            img = self.entries.get(key)
+            if img is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                cacheRequests.inc(result="hit")
+                return img
+            self.misses += 1
+            cacheRequests.inc(result="miss")
+            future = self.loading.get(key)
+            waiting = future is not None
+            if not waiting:
+                future = self.loading[key] = concurrent.futures.Future()
+
+        if not waiting:
+            return self.loadEntry(key, path, future)
+        try:
+            with tracing.span("wait for prefetch", file=path):
+                return future.result()
+        except Exception:
+            # Try again, reporting the error to the caller
+            img = self.load(path)
+            self.put(key, img)
+            return img
+
+
+    def prefetch(self, paths):
+        for i in paths:
+            key = self.makeKey(i)
+            with self.lock:
+                if key in self.entries: continue
+            self.pending.put((key, i))
+
+
+    def worker(self):
+        while True:
+            key, path = self.pending.get()
+            with self.lock:
+                if key in self.entries or key in self.loading: continue
+                future = self.loading[key] = concurrent.futures.Future()
+            try:
+                self.loadEntry(key, path, future)
+            except Exception:
+                logger.exception("Failed to prefetch %s", path)
+
+
+    def loadEntry(self, key, path, future):
+        ''' Load the image into the cache, and pass it to the threads
+        waiting for it through the future registered in self.loading '''
+        try:
+            img = self.load(path)
+            self.put(key, img)
+            future.set_result(img)
+            return img
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                self.loading.pop(key, None)
+
+
+    def load(self, path):
+        with decodeTime.time():
+            with tracing.span("decode", file=path):
+                img = self.decode(path)
+            if img.isNull(): return img
+            with tracing.span("scale", file=path):
+                return img.scaled(self.width, self.height, QtCore.Qt.KeepAspectRatio,
+                                  QtCore.Qt.SmoothTransformation)
+
+
+    def decode(self, path):
+        ''' Read the image; JPEGs are decoded directly at the smallest
+        scale that is still at least the size they are shown at '''
+        reader = QtGui.QImageReader(path)
+        if reader.format() == b'jpeg' and reader.size().isValid():
+            size = (reader.size().width(), reader.size().height())
+            target = imgload.fitSize(size, (self.width, self.height))
+            factor = imgload.getReduction(size, target)
+            if factor > 1:
+                reader.setScaledSize(QtCore.QSize(*imgload.getReducedSize(size, factor)))
+        return reader.read()
+
+
+    def put(self, key, img):
+        if img.isNull(): return
+        with self.lock:
+            if key in self.entries: return
+            self.entries[key] = img
+            self.totalBytes += img.byteCount()
+            while self.totalBytes > self.maxBytes and len(self.entries) > 1:
+                k, evicted = self.entries.popitem(last=False)
+                self.totalBytes -= evicted.byteCount()
+
+
+    def makeKey(self, path):
+        try: return (path, os.path.getmtime(path))
+        except OSError: return (path, None)
+
+
 class ImageViewer():
-    def __init__(self, title):
+    DEFAULT_CACHE_SIZE = 64 * 1024 * 1024
+
+    def __init__(self, title, prefetchCount=0, cacheSize=None):
         self.width = screenGeometry.width()
         self.height = screenGeometry.height()
+        self.prefetchCount = prefetchCount
+        self.cache = ImageCache(self.width, self.height,
+                                cacheSize or self.DEFAULT_CACHE_SIZE)
         self.label = QtWidgets.QLabel()
         self.label.setWindowTitle(title)
         self.label.setStyleSheet("background-color: black")
@@ -41,13 +200,17 @@ class ImageViewer():
         logger.debug("ImageViewer show " + str(url))
         self.loadSignal(url)
 
+    def prefetch(self, urls):
+        self.cache.prefetch(map(lambda i: i.replace('file://', ''), urls))
+
+    @tracing.traced("ImageViewer.actuallyShow")
     def actuallyShow(self, imagePath):
         self.makeVisible()
         p = imagePath.replace('file://', '')
         logger.debug("ImageViewer load " + p)
-        pixmap = QtGui.QPixmap(p)
-        pixmap = pixmap.scaled(self.width, self.height, QtCore.Qt.KeepAspectRatio)
-        self.label.setPixmap(pixmap)
+        img = self.cache.get(p)
+        with tracing.span("setPixmap"):
+            self.label.setPixmap(QtGui.QPixmap.fromImage(img))
 
     def makeVisible(self):
         global activeView
@@ -62,11 +225,14 @@ class ImageViewer():
 
 
 class WebViewer():
-    def __init__(self, title):
-        self.webview = QWebView()
+    def __init__(self, title, saveSnapshots=False):
+        self.webview = importWebView()()
         self.webview.setWindowTitle(title)
         self.webview.setCursor(QtCore.Qt.BlankCursor)
         self.loadSignal = Signal(self.actuallyShow)
+        self.url = None
+        if saveSnapshots:
+            self.webview.loadFinished.connect(self.onLoadFinished)
 
     def show(self, url):
         logger.debug("WebViewer show " + str(url))
@@ -74,9 +240,19 @@ class WebViewer():
 
     def actuallyShow(self, url):
         logger.debug("WebViewer load " + str(url))
+        self.url = url
         self.webview.load(QtCore.QUrl(url))
         self.makeVisible()
 
+    def onLoadFinished(self, ok):
+        # The page is rendered anyway, keep it for the next time
+        url = self.url
+        if ok: QtCore.QTimer.singleShot(SETTLE_TIME, lambda: self.saveSnapshot(url))
+
+    def saveSnapshot(self, url):
+        if url == self.url and activeView is self:
+            saveSnapshot(self.webview, url)
+
     def makeVisible(self):
         global activeView
         if activeView is self: return
@@ -89,17 +265,175 @@ class WebViewer():
         self.webview.hide()
 
 
+# ------------------------------------------------------------------------------
+
+# Web pages are shown from snapshots saved in this directory
+SNAPSHOTS_DIR = "snapshots"
+SNAPSHOT_QUALITY = 90
+
+# Time to let scripts and web fonts finish after a page has loaded, in ms
+SETTLE_TIME = 3000
+
+def getSnapshotPath(url):
+    return os.path.join(SNAPSHOTS_DIR, hashlib.sha1(url.encode()).hexdigest() + ".jpg")
+
+
+def getSnapshotAge(url):
+    ''' Return the age of the snapshot of the URL in seconds, or None '''
+    try: return time.time() - os.path.getmtime(getSnapshotPath(url))
+    except OSError: return None
+
+
+def saveSnapshot(widget, url):
+    path = getSnapshotPath(url)
+    os.makedirs(SNAPSHOTS_DIR, exist_ok=True)
+    tmp = path + ".tmp"
+    if widget.grab().save(tmp, "JPG", SNAPSHOT_QUALITY):
+        os.replace(tmp, path)
+        logger.debug("Saved snapshot of %s", url)
+    else:
+        logger.warning("Failed to save snapshot of %s", url)
+
+
+class SnapshotRenderer():
+    ''' Renders web pages in a view that is not shown on the screen, one
+    page at a time, and saves them as snapshots. The view is emptied when
+    done, so pages do not keep running scripts in the background.
+    '''
+
+    def __init__(self, width, height):
+        self.webview = importWebView()()
+        self.webview.setAttribute(QtCore.Qt.WA_DontShowOnScreen)
+        self.webview.resize(width, height)
+        self.webview.loadFinished.connect(self.onLoadFinished)
+        self.queue = collections.deque()
+        self.current = None
+        self.saving = False
+        self.requestSignal = Signal(self.enqueue)
+
+    def request(self, url):
+        ''' Render the URL in the background; can be called from any thread '''
+        self.requestSignal(url)
+
+    def enqueue(self, url):
+        if url == self.current or url in self.queue: return
+        self.queue.append(url)
+        if self.current is None: self.loadNext()
+
+    def loadNext(self):
+        self.current = self.queue.popleft() if self.queue else None
+        if self.current is None:
+            self.webview.setUrl(QtCore.QUrl("about:blank"))
+            return
+
+        logger.debug("Rendering snapshot of %s", self.current)
+        if not self.webview.isVisible(): self.webview.show()
+        self.webview.load(QtCore.QUrl(self.current))
+
+    def onLoadFinished(self, ok):
+        if self.current is None or self.saving: return
+        if not ok:
+            logger.warning("Failed to load %s for a snapshot", self.current)
+            self.loadNext()
+            return
+        self.saving = True
+        QtCore.QTimer.singleShot(SETTLE_TIME, self.save)
+
+    def save(self):
+        self.saving = False
+        try:
+            saveSnapshot(self.webview, self.current)
+        except Exception:
+            logger.exception("Failed to save snapshot of %s", self.current)
+        self.loadNext()
+
+
+# The last image shown, painted first on the next start
+LAST_IMAGE_FILE = "last-image"
+
 class UniversalViewer:
-    def __init__(self, title):
-        self.imageViewer = ImageViewer(title)
-        self.webViewer = WebViewer(title)
+    ''' Shows images, and web pages from their snapshots if they are at
+    most snapshotAge seconds old. Older pages are loaded live. Without
+    snapshotAge, web pages are always loaded live.
+
+    The web viewers are only created by enableWeb(), which has to be
+    called from the GUI thread before web pages are shown.
+    '''
+
+    def __init__(self, title, prefetchCount=0, cacheSize=None, snapshotAge=None):
+        self.title = title
+        self.imageViewer = ImageViewer(title, prefetchCount, cacheSize)
+        self.webViewer = None
+        self.prefetchCount = prefetchCount
+        self.snapshotAge = snapshotAge
+        self.renderer = None
+
+
+    def enableWeb(self):
+        if self.webViewer is not None: return
+        self.webViewer = WebViewer(self.title, bool(self.snapshotAge))
+        if self.snapshotAge:
+            self.renderer = SnapshotRenderer(*getScreenSize())
 
 
     def show(self, url):
-        if url.startswith('http://') or url.startswith('https://'):
-            self.webViewer.show(url)
+        snapshot = self.getSnapshot(url) if isWebUrl(url) else None
+        if snapshot:
+            self.showImage(snapshot)
+        elif isWebUrl(url):
+            if self.webViewer: self.webViewer.show(url)
+            else: logger.warning("Cannot show %s, web pages are not enabled", url)
         else:
-            self.imageViewer.show(url)
+            self.showImage(url)
+
+
+    def showImage(self, url):
+        self.imageViewer.show(url)
+        try:
+            with open(LAST_IMAGE_FILE + ".tmp", 'w') as f:
+                f.write(url)
+            os.replace(LAST_IMAGE_FILE + ".tmp", LAST_IMAGE_FILE)
+        except OSError as e:
+            logger.debug("Failed to save the last image: %s", e)
+
+
+    def showLast(self):
+        ''' Show the image that was on the screen when the app last ran, before
+        anything else is loaded. Must be called from the GUI thread. '''
+        try:
+            with open(LAST_IMAGE_FILE) as f:
+                url = f.read().strip()
+        except OSError:
+            return
+        if not os.path.exists(url.replace('file://', '')): return
+
+        logger.debug("Showing the last image %s", url)
+        self.imageViewer.actuallyShow(url)
+        app.processEvents()
+
+
+    def prefetch(self, urls):
+        urls = map(lambda i: self.getSnapshot(i) if isWebUrl(i) else i, urls)
+        self.imageViewer.prefetch(filter(None, urls))
+
+
+    def getSnapshot(self, url):
+        ''' Return the path of a fresh snapshot of the web page, or None '''
+        if not self.snapshotAge: return None
+        age = getSnapshotAge(url)
+        if age is None or age > self.snapshotAge: return None
+        return getSnapshotPath(url)
+
+
+    def refreshSnapshots(self, urls):
+        ''' Render the web pages among the URLs in the background '''
+        if self.renderer is None: return
+        for i in filter(isWebUrl, urls):
+            self.renderer.request(i)
+
+
+def isWebUrl(url):
+    return url.startswith('http://') or url.startswith('https://')
 
 
 # ------------------------------------------------------------------------------
@@ -110,11 +444,17 @@ timer = None
 
 def init(argv):
     global app, screenGeometry
+    # Allows the web engine to be imported after the application is created
+    QtCore.QCoreApplication.setAttribute(QtCore.Qt.AA_ShareOpenGLContexts)
     app = QtWidgets.QApplication(argv)
     screenGeometry = app.screens()[0].geometry()
     workaroundToAllowSignalProcessing()
 
 
+def getScreenSize():
+    return (screenGeometry.width(), screenGeometry.height())
+
+
 def workaroundToAllowSignalProcessing():
     # Qt main prevents python signal handlers from running
     # until a Qt event happens. To work around this,
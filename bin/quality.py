@@ -0,0 +1,241 @@
+import catalog
+import imgload
+import metrics
+import time
+import logging
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+logger = logging.getLogger("sync")
+
+# Low quality images are moved to the end of the sol, or left out
+DEMOTE = "demote"
+DROP = "drop"
+
+# Images are scored at this size, in grayscale; it is a multiple of the
+# 9x8 grid of the hash
+SCORE_SIZE = (144, 96)
+HASH_GRID = (9, 8)
+
+# Hashes of images of the other sols in the slideshow compared with
+# a new sol, at most
+MAX_KNOWN_HASHES = 2000
+
+# Pixel values counted as clipped, and the gradient counted as an edge
+CLIP_LOW = 4
+CLIP_HIGH = 251
+EDGE_GRADIENT = 24
+
+scoredImages = metrics.counter("duna_quality_images_total", "Images scored, by result")
+
+# Number of bits set in each byte value
+POPCOUNT = numpy.array(list(map(lambda i: bin(i).count('1'), range(256))), dtype=numpy.uint8) \
+    if numpy else None
+
+# ------------------------------------------------------------------------------
+
+def score(images):
+    ''' Return a dict of score name -> array with one value per image,
+    given a (count, height, width) array of grayscale pixels:
+    entropy - of the histogram, in bits, 0 to 8
+    stddev - of the pixel values, 0 to 127.5
+    clipped - fraction of pixels that are black or white
+    edges - fraction of pixels at an edge
+    '''
+    count = images.shape[0]
+    pixels = images.shape[1] * images.shape[2]
+
+    # All histograms in one pass: each image gets its own range of 256 bins
+    offsets = numpy.arange(count).reshape(count, 1, 1) * 256
+    histograms = numpy.bincount((images + offsets).ravel(), minlength=count * 256)
+    p = histograms.reshape(count, 256) / pixels
+    logs = numpy.log2(p, out=numpy.zeros_like(p), where=p > 0)
+
+    values = images.astype(numpy.float32)
+    gradient = numpy.abs(numpy.diff(values, axis=2))[:, :-1, :] + \
+               numpy.abs(numpy.diff(values, axis=1))[:, :, :-1]
+    return {
+        "entropy": -(p * logs).sum(axis=1),
+        "stddev": values.std(axis=(1, 2)),
+        "clipped": ((images <= CLIP_LOW) | (images >= CLIP_HIGH)).mean(axis=(1, 2)),
+        "edges": (gradient > EDGE_GRADIENT).mean(axis=(1, 2)),
+    }
+
+
+def dhash(images):
+    ''' Return the difference hashes of a (count, height, width) array of
+    grayscale pixels, as uint64: each bit tells if a cell of a 9x8 grid is
+    brighter than the cell to its left. Similar images have hashes that
+    differ in few bits. '''
+    count, h, w = images.shape
+    columns, rows = HASH_GRID
+    cells = images.reshape(count, rows, h // rows, columns, w // columns).mean(axis=(2, 4))
+    bits = (cells[:, :, 1:] > cells[:, :, :-1]).reshape(count, 64)
+    weights = numpy.left_shift(numpy.uint64(1), numpy.arange(64, dtype=numpy.uint64))
+    return (bits * weights).sum(axis=1, dtype=numpy.uint64)
+
+
+def getDistances(a, b):
+    ''' Return the (len(a), len(b)) array of Hamming distances of the hashes '''
+    x = numpy.bitwise_xor.outer(a, b)
+    return POPCOUNT[x.view(numpy.uint8)].reshape(x.shape + (8,)).sum(axis=-1)
+
+
+def findDuplicates(hashes, order, maxDistance):
+    ''' Return a boolean array telling which hashes are within maxDistance
+    of a hash before them in order that is not itself a duplicate.
+    The first image of each group represents it. '''
+    duplicates = numpy.zeros(len(hashes), dtype=bool)
+    distances = getDistances(hashes, hashes)
+    representatives = []
+    for i in order:
+        if len(representatives) > 0 and distances[i, representatives].min() <= maxDistance:
+            duplicates[i] = True
+        else:
+            representatives.append(i)
+    return duplicates
+
+
+def findRepeats(hashes, known, knownSols, maxDistance):
+    ''' Return an array with, for each hash, the sol of the nearest known
+    hash within maxDistance, or -1 if there is none '''
+    if len(known) == 0: return numpy.full(len(hashes), -1)
+    distances = getDistances(hashes, known)
+    nearest = distances.argmin(axis=1)
+    return numpy.where(distances.min(axis=1) <= maxDistance, knownSols[nearest], -1)
+
+
+def loadGray(path):
+    return numpy.asarray(imgload.load(path, SCORE_SIZE, fit=False).convert('L'),
+                         dtype=numpy.intp)
+
+
+class QualityFilter():
+    ''' Finds black, saturated and nearly blank rover images, and near
+    duplicates of other images, e.g. from bursts and mosaics.
+    An image is low quality if any score is past its threshold:
+    minEntropy - bits of the histogram; flat images have little
+    minStddev - spread of the pixel values
+    maxClipped - fraction of black or white pixels
+    minEdges - fraction of pixels at an edge; blank images have almost none
+    Images whose hashes differ in at most duplicateDistance of 64 bits are
+    near duplicates; None turns that check off.
+    '''
+
+    def __init__(self, action=DEMOTE, minEntropy=3.0, minStddev=6.0, maxClipped=0.6,
+                 minEdges=0.002, duplicateDistance=6):
+        self.action = action
+        self.minEntropy = minEntropy
+        self.minStddev = minStddev
+        self.maxClipped = maxClipped
+        self.minEdges = minEdges
+        self.duplicateDistance = duplicateDistance
+        self.enabled = True
+        self.warned = False
+
+
+    def configure(self, config):
+        ''' Apply the "quality" section of the config; false disables the filter '''
+        if config is False:
+            self.enabled = False
+            return
+        config = config or {}
+        self.action = config.get("action", self.action)
+        self.minEntropy = config.get("minEntropy", self.minEntropy)
+        self.minStddev = config.get("minStddev", self.minStddev)
+        self.maxClipped = config.get("maxClipped", self.maxClipped)
+        self.minEdges = config.get("minEdges", self.minEdges)
+        self.duplicateDistance = config.get("duplicateDistance", self.duplicateDistance)
+
+
+    def isAvailable(self):
+        if numpy is None and self.enabled and not self.warned:
+            logger.warning("numpy is not installed, images are not filtered by quality")
+            self.warned = True
+        return self.enabled and numpy is not None
+
+
+    def check(self, files, rover, kind, sol, otherSols=(), pool=None):
+        ''' Score and hash the images of a sol and record the results in the
+        catalog. Images that repeat ones of otherSols, the other sols shown
+        with this one, count as near duplicates too.
+        Returns (low quality paths, near duplicate paths) as sets. '''
+        if len(files) == 0 or not self.isAvailable(): return (set(), set())
+
+        start = time.monotonic()
+        mapper = pool.map if pool else map
+        loaded = list(filter(lambda i: i[1] is not None, zip(files, mapper(self.tryLoad, files))))
+        if len(loaded) == 0: return (set(), set())
+        files = list(map(lambda i: i[0], loaded))
+        images = numpy.stack(list(map(lambda i: i[1], loaded)))
+        scores = score(images)
+        hashes = dhash(images)
+
+        failed = {
+            "flat": scores["entropy"] < self.minEntropy,
+            "dark or uniform": scores["stddev"] < self.minStddev,
+            "clipped": scores["clipped"] > self.maxClipped,
+            "blank": scores["edges"] < self.minEdges,
+        }
+        low = numpy.logical_or.reduce(list(failed.values()))
+        duplicates, repeats = self.findDuplicates(hashes, low, scores["edges"],
+                                                  rover, kind, otherSols)
+
+        catalog.db.setQuality(map(lambda i: (files[i], bool(low[i]), int(hashes[i]),
+                                             bool(duplicates[i]),
+                                             int(repeats[i]) if repeats[i] >= 0 else None),
+                                  range(len(files))))
+        duplicates = duplicates | (repeats >= 0)
+        scoredImages.inc(int((~low & ~duplicates).sum()), result="ok")
+        scoredImages.inc(int((low & ~duplicates).sum()), result="low")
+        scoredImages.inc(int(duplicates.sum()), result="duplicate")
+        logger.info("Quality of %s sol %d: %d of %d images low (%s), %d near duplicates, "
+                    "median entropy %.1f, stddev %.1f, edges %.3f, scored in %.2fs",
+                    rover, sol, low.sum(), len(files),
+                    ", ".join(map(lambda i: "%d %s" % (i[1].sum(), i[0]), failed.items())),
+                    duplicates.sum(), numpy.median(scores["entropy"]),
+                    numpy.median(scores["stddev"]), numpy.median(scores["edges"]),
+                    time.monotonic() - start)
+        pick = lambda mask: set(map(lambda i: i[0], filter(lambda i: i[1], zip(files, mask))))
+        return (pick(low), pick(duplicates))
+
+
+    def findDuplicates(self, hashes, low, edges, rover, kind, otherSols):
+        ''' Return (duplicates within the sol, sols repeated by the others) '''
+        if self.duplicateDistance is None:
+            return (numpy.zeros(len(hashes), dtype=bool), numpy.full(len(hashes), -1))
+        # The sharpest image of good quality represents a group
+        order = sorted(range(len(hashes)), key=lambda i: (low[i], -edges[i]))
+        duplicates = findDuplicates(hashes, order, self.duplicateDistance)
+
+        known = catalog.db.listHashes(rover, kind, otherSols, MAX_KNOWN_HASHES)
+        repeats = findRepeats(hashes,
+                              numpy.array(list(map(lambda i: i[1], known)), dtype=numpy.uint64),
+                              numpy.array(list(map(lambda i: i[0], known)), dtype=int),
+                              self.duplicateDistance)
+        return (duplicates, numpy.where(duplicates, -1, repeats))
+
+
+    def tryLoad(self, path):
+        try:
+            return loadGray(path)
+        except Exception:
+            logger.exception("Failed to score %s", path)
+            return None
+
+
+    def arrange(self, files, lowFiles, duplicates):
+        ''' Return the files without the near duplicates, and with the low
+        quality ones moved to the end, or left out, depending on the action '''
+        if not self.enabled: return list(files)
+        files = list(filter(lambda i: i not in duplicates, files))
+        good = list(filter(lambda i: i not in lowFiles, files))
+        if self.action == DROP: return good
+        return good + list(filter(lambda i: i in lowFiles, files))
+
+
+imageFilter = QualityFilter()
@@ -0,0 +1,124 @@
+import random
+import threading
+import time
+import logging
+
+
+logger = logging.getLogger("sync")
+
+# api.nasa.gov allows 1000 requests per hour for a registered key
+REQUESTS_PER_HOUR = 1000
+BURST = 40
+
+# The quota of the server is counted per hour; when the remaining quota
+# it reports runs low, requests are paused until the next hour
+WINDOW = 60 * 60
+PAUSE_ON_QUOTA = True
+
+# Retries of requests that failed with 429 or a server error
+RETRIES = 4
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 60.0
+
+# ------------------------------------------------------------------------------
+
+class TokenBucket:
+    ''' Token bucket rate limiter. Each request takes one token, tokens are
+    refilled at a constant rate up to the burst capacity. The bucket is
+    also drained to the remaining quota reported by the server, and
+    paused, not refilled at all, until the server's quota is restored.
+    '''
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.pausedUntil = None
+        self.lock = threading.Lock()
+
+
+    def refill(self):
+        now = time.monotonic()
+        if self.pausedUntil is not None:
+            if now < self.pausedUntil:
+                self.updated = now
+                return
+            logger.info("Rate limit quota restored")
+            self.pausedUntil = None
+            self.tokens = self.capacity
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+
+    def acquire(self):
+        ''' Take a token, waiting until one is available '''
+        while True:
+            with self.lock:
+                self.refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                if self.pausedUntil is not None:
+                    wait = self.pausedUntil - self.updated
+                else:
+                    wait = (1 - self.tokens) / self.rate
+            logger.debug("Rate limit reached, waiting %.1fs", wait)
+            time.sleep(wait)
+
+
+    def setRemaining(self, remaining):
+        ''' Limit the available tokens to the quota reported by the server.
+        When less than a burst is left, the remaining tokens are not
+        refilled until the next hour window. '''
+        with self.lock:
+            self.refill()
+            self.tokens = min(self.tokens, remaining)
+            if PAUSE_ON_QUOTA and remaining < BURST:
+                self.pause(WINDOW - time.time() % WINDOW)
+
+
+    def setRetryAfter(self, seconds):
+        ''' Take all tokens until the server accepts requests again '''
+        with self.lock:
+            self.refill()
+            self.tokens = 0
+            self.pause(seconds)
+
+
+    def pause(self, seconds):
+        ''' Stop refilling the tokens for given time '''
+        until = time.monotonic() + seconds
+        if self.pausedUntil is None:
+            logger.warning("Rate limit quota running out, pausing refills for %.0fs", seconds)
+            self.pausedUntil = until
+        else:
+            self.pausedUntil = max(self.pausedUntil, until)
+
+
+limiters = {}
+limitersLock = threading.Lock()
+
+def getLimiter(key):
+    ''' Return the rate limiter shared by all users of the API key '''
+    with limitersLock:
+        l = limiters.get(key)
+        if l is None:
+            l = TokenBucket(REQUESTS_PER_HOUR / 3600, BURST)
+            limiters[key] = l
+        return l
+
+
+# ------------------------------------------------------------------------------
+
+def isRetryable(status):
+    return status == 429 or status >= 500
+
+
+def getRetryDelay(attempt, retryAfter=None):
+    ''' Return the time to wait before retry number attempt (from 0):
+    the server's Retry-After if given, otherwise exponential backoff
+    with full jitter '''
+    if retryAfter is not None and retryAfter.isdigit():
+        return min(BACKOFF_MAX, int(retryAfter))
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
@@ -1,42 +1,242 @@
 import threading
+import heapq
+import itertools
 import time
+import concurrent.futures
+import logging
+
+
+logger = logging.getLogger("sched")
+
+# What to do with the runs of a fixed-rate task that were missed, because
+# the previous run was still going or the dispatcher was late
+SKIP = "skip"           # drop them and continue at the next period
+CATCH_UP = "catchup"    # run them as soon as possible, one after another
+
+# The most runs a CATCH_UP task can fall behind; older ones are dropped
+MAX_PENDING_RUNS = 3
+
+
+class Cancelled(Exception):
+    pass
+
+
+class Deadline():
+    ''' Cooperative cancellation of long operations. The operation checks
+    the deadline between steps and stops once it has expired, either
+    because the timeout passed or because it was cancelled.
+    '''
+
+    def __init__(self, timeout=None):
+        self.expires = time.monotonic() + timeout if timeout else None
+        self.cancelled = False
+
+
+    def cancel(self):
+        self.cancelled = True
+
+
+    def isExpired(self):
+        return self.cancelled or \
+            (self.expires is not None and time.monotonic() >= self.expires)
+
+
+    def getRemaining(self):
+        ''' Return seconds left, or None if there is no time limit '''
+        if self.expires is None: return None
+        return max(0.0, self.expires - time.monotonic())
+
+
+    def check(self):
+        ''' Raise Cancelled if the deadline has expired '''
+        if self.isExpired(): raise Cancelled()
+
+
+# ------------------------------------------------------------------------------
+
+
+class Task():
+    ''' A scheduled task, returned by the Scheduler as a handle that can be
+    used to cancel the task and to read its run-time statistics.
+
+    Fixed-rate tasks are due every period from the first deadline,
+    regardless of how long they run. Fixed-delay tasks are due period
+    seconds after the previous run finished.
+    '''
+
+    def __init__(self, name, fn, args, deadline, period, fixedRate, missed):
+        self.name = name
+        self.fn = fn
+        self.args = args
+        self.deadline = deadline
+        self.period = period
+        self.fixedRate = fixedRate
+        self.missed = missed
+        self.cancelled = False
+        self.running = False
+        self.pendingRuns = 0
+
+        self.runs = 0
+        self.missedRuns = 0
+        self.totalTime = 0.0
+        self.maxTime = 0.0
+        self.lastLag = 0.0
+
+
+    def cancel(self):
+        self.cancelled = True
+
+
+    def isPeriodic(self):
+        return self.period is not None
+
+
+    def getStats(self):
+        return {
+            "name": self.name,
+            "runs": self.runs,
+            "missed": self.missedRuns,
+            "avgTime": self.totalTime / self.runs if self.runs else 0.0,
+            "maxTime": self.maxTime,
+            "lag": self.lastLag,
+        }
+
 
 class Scheduler():
-    def __init__(self):
-        self.tasks = []
-        self.lock = threading.Lock()
+    ''' Runs tasks at their deadlines, using one dispatcher thread that
+    waits for the earliest deadline in a heap. Due tasks are handed to
+    a small pool of worker threads, so a long task does not delay the
+    others; a task never runs concurrently with itself.
+    '''
+
+    WORKERS = 4
+
+    def __init__(self, workers=None):
+        self.heap = []
+        self.sequence = itertools.count()
+        self.cond = threading.Condition()
         self.alive = True
+        self.tasks = []
+        self.pool = concurrent.futures.ThreadPoolExecutor(workers or self.WORKERS)
+        self.thread = threading.Thread(target=self.dispatch, daemon=True)
+        self.thread.start()
 
 
-    def runPeriodically(self, period, task, args=()):
-        t = threading.Timer(period, self.wrapper, (period, task, args))
-        t.start()
-        with self.lock:
-            self.tasks.append(t)
+    def runPeriodically(self, period, task, args=(), fixedRate=True, missed=SKIP):
+        ''' Run the task every period seconds, starting one period from now '''
+        t = Task(getName(task), task, args, time.monotonic() + period, period,
+                 fixedRate, missed)
+        self.schedule(t)
+        return t
 
 
     def runAfter(self, period, task, args=()):
-        t = threading.Timer(period, task, args)
-        t.start()
-        with self.lock:
-            self.tasks.append(t)
+        ''' Run the task once, period seconds from now '''
+        t = Task(getName(task), task, args, time.monotonic() + period, None, True, SKIP)
+        self.schedule(t)
+        return t
+
+
+    def schedule(self, t):
+        with self.cond:
+            if t not in self.tasks: self.tasks.append(t)
+            heapq.heappush(self.heap, (t.deadline, next(self.sequence), t))
+            self.cond.notify()
+
+
+    def dispatch(self):
+        while True:
+            with self.cond:
+                while self.alive and not self.isDue():
+                    timeout = self.heap[0][0] - time.monotonic() if self.heap else None
+                    self.cond.wait(timeout)
+                if not self.alive: return
+                deadline, n, t = heapq.heappop(self.heap)
+
+            if t.cancelled:
+                self.forget(t)
+                continue
+
+            self.start(t, deadline)
+            if t.isPeriodic() and t.fixedRate:
+                self.scheduleNextRun(t, deadline)
 
-    def wrapper(self, period, task, args):
-        if not self.alive: return
 
-        self.pruneDeadTasks()
-        task(*args)
-        self.runPeriodically(period, task, args)
+    def start(self, t, deadline):
+        with self.cond:
+            if t.running and t.missed == CATCH_UP and t.pendingRuns < MAX_PENDING_RUNS:
+                t.pendingRuns += 1
+            elif t.running:
+                logger.debug("Skipping %s, previous run still in progress", t.name)
+                t.missedRuns += 1
+            else:
+                t.running = True
+                self.pool.submit(self.run, t, deadline)
 
 
-    def pruneDeadTasks(self):
-        with self.lock:
-            self.tasks = list(filter(lambda i:i.is_alive(), self.tasks))
+    def isDue(self):
+        return len(self.heap) > 0 and self.heap[0][0] <= time.monotonic()
+
+
+    def scheduleNextRun(self, t, previous):
+        now = time.monotonic()
+        t.deadline = previous + t.period
+        if t.deadline < now and t.missed == SKIP:
+            missed = int((now - t.deadline) // t.period) + 1
+            t.missedRuns += missed
+            t.deadline += missed * t.period
+        self.schedule(t)
+
+
+    def run(self, t, deadline):
+        while True:
+            start = time.monotonic()
+            t.lastLag = start - deadline
+            try:
+                t.fn(*t.args)
+            except Exception:
+                logger.exception("Task %s failed", t.name)
+
+            elapsed = time.monotonic() - start
+            t.runs += 1
+            t.totalTime += elapsed
+            t.maxTime = max(t.maxTime, elapsed)
+
+            # Runs that came due while this one was in progress
+            with self.cond:
+                if t.pendingRuns == 0 or t.cancelled or not self.alive:
+                    t.running = False
+                    break
+                t.pendingRuns -= 1
+                deadline = start + elapsed
+
+        if t.isPeriodic() and not t.fixedRate and not t.cancelled:
+            t.deadline = time.monotonic() + t.period
+            self.schedule(t)
+        elif not t.isPeriodic() or t.cancelled:
+            self.forget(t)
+
+
+    def forget(self, t):
+        with self.cond:
+            if t in self.tasks: self.tasks.remove(t)
+
+
+    def getStats(self):
+        with self.cond:
+            return list(map(lambda i: i.getStats(), self.tasks))
 
 
     def kill(self):
-        self.alive = False
-        with self.lock:
-            for i in self.tasks:
-                i.cancel()
+        with self.cond:
+            self.alive = False
+            for (d, n, t) in self.heap:
+                t.cancel()
+            self.heap.clear()
             self.tasks.clear()
+            self.cond.notify()
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+
+def getName(fn):
+    return getattr(fn, '__qualname__', None) or str(fn)
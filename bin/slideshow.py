@@ -2,6 +2,7 @@ import sys
 import os
 import time
 import threading
+import tracing
 import logging
 
 
@@ -12,17 +13,21 @@ class Slideshow():
     def __init__(self, viewer):
         self.viewer = viewer
         self.images = []
+        self.known = set()
         self.currentImage = 0
         self.lock = threading.Lock()
         self.changeListeners = []
+        self.showListeners = []
 
 
     def add(self, images):
         with self.lock:
             if hasattr(images, '__iter__') and type(images) is not str:
-                self.images.extend(images)
+                images = list(images)
             else:
-                self.images.append(images)
+                images = [ images ]
+            self.images.extend(images)
+            self.known.update(images)
 
             self.notifyAboutChange()
 
@@ -30,9 +35,44 @@ class Slideshow():
     def clear(self):
         with self.lock:
             self.images.clear()
+            self.known.clear()
             self.notifyAboutChange()
 
 
+    def merge(self, added=(), removed=()):
+        ''' Append new entries and drop removed ones, keeping the position
+        in the slideshow: the next image shown is the one that would have
+        been shown next without the change, unless it was removed.
+        Entries already in the slideshow are not added again.
+        '''
+        with self.lock:
+            removed = self.known.intersection(removed)
+            added = list(filter(lambda i: i not in self.known, dict.fromkeys(added)))
+            if len(removed) == 0 and len(added) == 0: return
+
+            if len(removed) > 0:
+                self.removeEntries(removed)
+            self.images.extend(added)
+            self.known.update(added)
+
+            self.notifyAboutChange()
+
+
+    def removeEntries(self, removed):
+        # The cursor is left on the last entry kept at or before it, or at -1
+        # if there is none, so that the next image is the first entry kept
+        # after it, even once new entries are appended
+        images = []
+        cursor = -1
+        for (i, img) in enumerate(self.images):
+            if img in removed: continue
+            if i <= self.currentImage: cursor = len(images)
+            images.append(img)
+        self.images = images
+        self.known.difference_update(removed)
+        self.currentImage = cursor
+
+
     def nextImage(self):
         with self.lock:
             if len(self.images) == 0: return
@@ -51,6 +91,18 @@ class Slideshow():
             img = self.images[self.currentImage]
             logger.info("Show %s", img)
             self.viewer.show(img)
+            self.notifyAboutShow(img)
+            self.prefetchAround()
+
+
+    def prefetchAround(self):
+        # Let the viewer prepare the images most likely to be shown next,
+        # including the previous one in case the knob is turned back
+        n = min(getattr(self.viewer, 'prefetchCount', 0), len(self.images) - 1)
+        if n <= 0: return
+        offsets = list(range(1, n + 1)) + [ -1 ]
+        self.viewer.prefetch(map(lambda i: self.images[(self.currentImage + i) % len(self.images)],
+                                 offsets))
 
 
     def getLength(self):
@@ -67,6 +119,15 @@ class Slideshow():
             i()
 
 
+    def addShowListener(self, listener):
+        self.showListeners.append(listener)
+
+
+    def notifyAboutShow(self, img):
+        for i in self.showListeners:
+            i(img)
+
+
 class SlideshowChannels():
     def __init__(self):
         self.channels = []
@@ -80,6 +141,7 @@ class SlideshowChannels():
             self.nextChannel()
 
 
+    @tracing.traced("SlideshowChannels.nextImage")
     def nextImage(self):
         if len(self.channels) == 0: return
 
@@ -0,0 +1,150 @@
+import catalog
+import blobstore
+import metrics
+import derivatives
+import os
+import shutil
+import threading
+import time
+import logging
+
+
+logger = logging.getLogger("sync")
+
+# Eviction policies
+OLDEST = "oldest"          # sols furthest behind the latest sol of their rover first
+DISPLAYED = "displayed"    # sols least recently shown first
+
+# Same limit as the old limit_disk_usage.sh cron job
+BUDGET = 1000 * 1000 * 1000
+
+# ------------------------------------------------------------------------------
+
+def getDirSize(path):
+    ''' Return the size of the files in the directory, counting files
+    shared with other directories through the store in proportion '''
+    size = 0
+    for (d, dirs, files) in os.walk(path):
+        for i in files:
+            try: size += blobstore.getShare(os.stat(os.path.join(d, i)))
+            except OSError: pass
+    return int(size)
+
+
+def getSyncDir(imagePath):
+    ''' Return the sync directory of an image or of its display derivative '''
+    d = os.path.dirname(imagePath)
+    if os.path.basename(d) == derivatives.DERIVATIVES_DIR:
+        d = os.path.dirname(d)
+    return d
+
+
+class DiskBudget:
+    ''' Keeps the sync directories under baseDir within a budget of bytes,
+    deleting whole sols (every directory synced for the sol) until the
+    usage fits. Sols for which isProtected(rover, sol) is true, such as
+    the ones in a slideshow, are never deleted. Deleted sols stay recorded
+    in the catalog as evicted, so that backfills do not download them again.
+
+    With the DISPLAYED policy, a sol that has not been shown yet counts
+    as shown when it was synced.
+    '''
+
+    def __init__(self, baseDir, budget=BUDGET, policy=OLDEST):
+        self.baseDir = baseDir
+        self.budget = budget
+        self.policy = policy
+        self.lock = threading.Lock()
+        self.usage = 0
+        self.evictions = 0
+        self.bytesFreed = 0
+        self.lastRun = None
+
+
+    def listSols(self):
+        ''' Return a dict of (rover, sol) -> list of sync directories '''
+        sols = {}
+        for d in os.listdir(self.baseDir):
+            m = catalog.SYNC_DIR_PATTERN.match(d)
+            path = os.path.join(self.baseDir, d)
+            if not m or not os.path.isdir(path): continue
+            sols.setdefault((m.group(1), int(m.group(3))), []).append(path)
+        return sols
+
+
+    def getLastUse(self):
+        ''' Return a dict of sync directory -> time it was last shown or synced '''
+        return dict(map(lambda i: (i[3], i[5] or i[4]), catalog.db.listSyncs()))
+
+
+    def orderForEviction(self, sols):
+        if self.policy == DISPLAYED:
+            lastUse = self.getLastUse()
+            getTime = lambda d: lastUse.get(d) or os.path.getmtime(d)
+            return sorted(sols.keys(), key=lambda i: max(map(getTime, sols[i])))
+        # Sol numbers of different rovers are not comparable, rank them
+        # by how far behind the latest sol of the rover they are
+        rank = {}
+        for rover in set(map(lambda i: i[0], sols.keys())):
+            roverSols = sorted(filter(lambda i: i[0] == rover, sols.keys()), reverse=True)
+            rank.update(map(lambda i: (i[1], i[0]), enumerate(roverSols)))
+        return sorted(sols.keys(), key=lambda i: (-rank[i], i[1]))
+
+
+    def enforce(self, isProtected=lambda rover, sol: False):
+        ''' Delete sols until the usage fits in the budget.
+        Returns the number of bytes freed. '''
+        with self.lock:
+            sols = self.listSols()
+            sizes = dict(map(lambda i: (i, sum(map(getDirSize, sols[i]))), sols.keys()))
+            self.usage = sum(sizes.values())
+            self.lastRun = time.time()
+
+            freed = 0
+            for i in self.orderForEviction(sols):
+                if self.usage <= self.budget: break
+                rover, sol = i
+                if isProtected(rover, sol): continue
+
+                logger.info("Disk budget: evicting %s sol %d, %d bytes", rover, sol, sizes[i])
+                catalog.db.removeSol(rover, sol)
+                for d in sols[i]:
+                    shutil.rmtree(d, ignore_errors=True)
+                self.usage -= sizes[i]
+                self.evictions += 1
+                self.bytesFreed += sizes[i]
+                freed += sizes[i]
+
+            # Files replaced or evicted since the last run
+            blobstore.gc()
+            if freed > 0:
+                # Files shared with the evicted sols are now counted in full
+                dirs = sum(self.listSols().values(), [])
+                self.usage = sum(map(getDirSize, dirs))
+
+            if self.usage > self.budget:
+                logger.warning("Disk budget: %d bytes used, over the budget of %d, "
+                               "the remaining sols are in use", self.usage, self.budget)
+            else:
+                logger.debug("Disk budget: %d of %d bytes used", self.usage, self.budget)
+            return freed
+
+
+    def getStats(self):
+        with self.lock:
+            return {
+                "usage": self.usage,
+                "budget": self.budget,
+                "policy": self.policy,
+                "evictions": self.evictions,
+                "bytesFreed": self.bytesFreed,
+                "lastRun": self.lastRun,
+            }
+
+
+manager = DiskBudget("rovers")
+
+metrics.gauge("duna_disk_usage_bytes", "Disk space used by the synced sols",
+              lambda: [ ({}, manager.getStats()["usage"]) ])
+metrics.counter("duna_disk_evictions_total", "Sols deleted to keep within the disk budget",
+                lambda: [ ({}, manager.getStats()["evictions"]) ])
@@ -1,15 +1,26 @@
-import wget
+import net
+import blobstore
+import metrics
+import tracing
+import derivatives
+import imgload
+import quality
+import catalog
+import sched
+import requests
 import time
 import os
-import re
 import PIL.Image as Image
-import tempfile
-import shutil
+import concurrent.futures
 import logging
 
 
 logger = logging.getLogger("sync")
 
+syncTime = metrics.histogram("duna_sync_seconds", "Time to sync a sol, by rover and kind")
+syncRate = metrics.gauge("duna_sync_throughput_bytes_per_second",
+                         "Download rate of the last sync of images, by rover")
+
 # ------------------------------------------------------------------------------
 
 def getFileName(url):
@@ -18,20 +29,25 @@ def getFileName(url):
 def mkdir(path):
     if not os.path.isdir(path): os.makedirs(path)
 
-def isImageFile(fileName):
-    n = fileName.lower()
-    return n.endswith('.jpg') or n.endswith('.jpeg') or n.endswith('.png')
+def getGridSize(layout):
+    ''' Return (columns, rows) of a dashboard layout '''
+    return (max(map(lambda i: i[0], layout.values())) + 1,
+            max(map(lambda i: i[1], layout.values())) + 1)
 
 def setup():
     mkdir("rovers")
     mkdir("slideshow")
+    mkdir(blobstore.STORE_DIR)
+    catalog.init("catalog.db", "rovers")
 
 # ------------------------------------------------------------------------------
 
 class RoverSync:
-    def __init__(self, api, baseDir, sol=None):
+    def __init__(self, api, baseDir, kind, sol=None, displaySize=None):
         self.api = api
         self.rover = api.ROVER
+        self.kind = kind
+        self.displaySize = displaySize
         self.sol = self.determineSol(sol)
         self.syncDir = baseDir + '-' + str(self.sol)
         self.captionsDir = self.syncDir + "/captions"
@@ -47,158 +63,339 @@ class RoverSync:
 
 
     def alreadySynced(self):
-        return os.path.isdir(self.syncDir)
+        return catalog.db.isSynced(self.rover, self.kind, self.sol)
+
+
+    def markSynced(self):
+        catalog.db.markSynced(self.rover, self.kind, self.sol, self.syncDir)
+
+
+    def markEmpty(self):
+        ''' Record that the sol has no images to sync, so that backfills do
+        not list it again. The latest sol is left out, as it may still
+        receive images. '''
+        if self.sol < self.api.getLastSol():
+            catalog.db.markSynced(self.rover, self.kind, self.sol, self.syncDir, empty=True)
+
+
+    def addImage(self, path, camera=None, url=None, digest=None):
+        catalog.db.addImage(self.rover, self.kind, self.sol, path, camera, url, digest)
+
+
+    def hasImagesIn(self, cameras):
+        ''' Determine if this sync uses images from any of the cameras '''
+        return True
 
 
     def filterImages(self, allImages, camera):
         return filter(lambda i: camera.upper() == i[1].upper(), allImages)
 
 
+    @tracing.traced("RoverSync.downloadImage", lambda self, url, outDir: { "url": url })
     def downloadImage(self, url, outDir):
+        ''' Download the image into the store and link it into outDir.
+        Returns (path, digest, bytes received) '''
+        fullResUrl = self.api.getFullresImg(url)
         try:
-            fullResUrl = self.api.getFullresImg(url)
             logger.debug("Downloading %s", fullResUrl)
-            n = wget.download(fullResUrl, outDir, bar=None)
-            return n
-        except:
+            n, digest, size, t = blobstore.download(fullResUrl, outDir)
+        except requests.HTTPError:
+            # The full-res variant does not exist for every image
+            if fullResUrl == url: raise
             logger.debug("Downloading %s", url)
-            n = wget.download(url, outDir, bar=None)
-            return n
+            n, digest, size, t = blobstore.download(url, outDir)
+
+        logger.debug("Downloaded %s: %d bytes in %.2fs (%s)",
+                     n, size, t, net.formatRate(size, t))
+        return (n, digest, size)
+
+
+    def makeDisplayImages(self, files, pool=None):
+        ''' Return display-sized derivatives of the synced files, or the
+        files themselves if the display size is not known '''
+        return makeDisplayImages(files, self.displaySize, pool)
+
+
+def makeDisplayImages(files, displaySize, pool=None):
+    if displaySize is None: return list(files)
+    return derivatives.makeAll(files, displaySize, pool)
 
 
 
 class RoverCameraSync(RoverSync):
     ''' Sync images from a rover captured at a specific sol '''
 
-    def listLatestImages(api):
-        r = re.compile(api.ROVER + '-[0-9]+$')
-        tmp = list(sorted(filter(r.match, os.listdir("rovers"))))
-        if len(tmp) == 0: return None
+    def listLatestImages(api, displaySize=None):
+        sol = catalog.db.getLatestSol(api.ROVER, catalog.CAMERA)
+        if sol is None: return None
+        return RoverCameraSync.listSolImages(api, sol, displaySize)
 
-        d = os.path.join("rovers", tmp[-1])
-        return map(lambda i:os.path.join(d, i),
-                   filter(isImageFile, os.listdir(d)))
 
+    def listSolImages(api, sol, displaySize=None):
+        lowFiles, duplicates = catalog.db.listQuality(api.ROVER, catalog.CAMERA, sol)
+        files = quality.imageFilter.arrange(
+            catalog.db.listImages(api.ROVER, catalog.CAMERA, sol), lowFiles, duplicates)
+        return makeDisplayImages(files, displaySize)
 
-    def __init__(self, api, sol=None, camera=None):
+
+    DEFAULT_CONCURRENCY = 4
+
+    def __init__(self, api, sol=None, camera=None, concurrency=None, limit=None,
+                 displaySize=None, listShownSols=None):
         ''' RoverCameraSync(api, sol)
         api - API key
         sol - sol number, or None None, to use the latest
         camera - specific camera, or None to use default
+        concurrency - number of parallel downloads, or None to use default
+        limit - maximum number of images to download, or None for all
+        displaySize - (width, height) of display derivatives, or None to skip them
+        listShownSols - function returning the other sols shown together with
+                        given sol, whose images are not repeated, or None
         '''
-        super().__init__(api, 'rovers/' + api.ROVER, sol)
+        super().__init__(api, 'rovers/' + api.ROVER, catalog.CAMERA, sol, displaySize)
         self.camera = camera or api.DEFAULT_CAMERA
+        self.concurrency = concurrency or self.DEFAULT_CONCURRENCY
+        self.limit = limit
+        self.listShownSols = listShownSols or (lambda sol: [])
+
+
+    def hasImagesIn(self, cameras):
+        return self.camera.upper() in map(str.upper, cameras)
 
 
-    def sync(self):
+    def sync(self, deadline=None):
+        ''' Download the images, stopping at the deadline.
+        Returns a list of synced files, or None if there was nothing to sync.
+        '''
+        self.deadline = deadline or sched.Deadline()
         if self.alreadySynced(): return None
 
-        images = self.api.listImages(self.sol, self.camera)
-        selected = list(filter(self.api.wantImage, images))
+        selected = list(self.api.listImages(self.sol, self.camera,
+                                            accept=self.api.wantImage,
+                                            limit=self.limit))
 
-        if len(selected) == 0: return None
+        if len(selected) == 0:
+            self.markEmpty()
+            return None
 
         mkdir(self.syncDir)
         mkdir(self.captionsDir)
 
-        outFiles = []
-        for i,c in selected:
-            try:
-                actual = self.downloadImage(i, self.syncDir)
-                outFiles.append(actual)
-            except Exception as e:
-                logger.exception('Failed to download %s', i)
+        start = time.monotonic()
+        with concurrent.futures.ThreadPoolExecutor(self.concurrency) as pool:
+            results = list(filter(None, pool.map(self.tryDownloadImage, selected)))
+            outFiles = list(map(lambda i: i[0], results))
+            elapsed = time.monotonic() - start
+
+            # An interrupted sol is completed by the next sync
+            self.deadline.check()
+            if len(outFiles) > 0: self.markSynced()
+
+            # Files already synced or linked from the store are not counted
+            size = sum(map(lambda i: i[1], results))
+            syncTime.observe(elapsed, rover=self.rover, kind=self.kind)
+            syncRate.set(size / max(elapsed, 0.001), rover=self.rover)
+            logger.info("Synced %d/%d %s images: %d bytes downloaded in %.1fs (%s)",
+                        len(outFiles), len(selected), self.rover, size, elapsed,
+                        net.formatRate(size, elapsed))
+
+            lowFiles, duplicates = quality.imageFilter.check(
+                outFiles, self.rover, self.kind, self.sol, self.listShownSols(self.sol), pool)
+            return self.makeDisplayImages(
+                quality.imageFilter.arrange(outFiles, lowFiles, duplicates), pool)
+
+
+    def tryDownloadImage(self, img):
+        ''' Returns (path, bytes received), or None if the download failed '''
+        url, camera = img
+        if self.deadline.isExpired(): return None
+        try:
+            # Images that landed before an interrupted sync are not downloaded again
+            n = catalog.db.findByUrl(url)
+            if n is not None and os.path.exists(n): return (n, 0)
+            n, digest, size = self.downloadImage(url, self.syncDir)
+            self.addImage(n, camera, url, digest)
+            return (n, size)
+        except Exception as e:
+            logger.exception('Failed to download %s', url)
+            return None
 
-        return outFiles
 
+class RoverDashboardSync(RoverSync):
+    ''' Sync images from several cameras of a rover captured at a specific sol
+    and combine the latest image from each camera into one composite image.
 
-class RoverHazcamSync(RoverSync):
-    ''' Sync hazcam images from a rover captured at a specific sol.
-    Creates a composite image from front/rear left/right HAZCAM images.
+    The layout maps camera names to the (column, row) of their tile.
+    Tiles are downloaded in parallel, decoded at reduced scale when
+    the composite is smaller than full size, and the composite is saved
+    as a JPEG at the display size.
     '''
 
-    def listLatestImages(api):
-        r = re.compile(api.ROVER + '-haz-[0-9]+$')
-        tmp = list(sorted(filter(r.match, os.listdir("rovers"))))
-        if len(tmp) > 0:
-            return os.path.join("rovers", tmp[-1], "dash-" + api.ROVER + ".png")
-        else:
-            return None
+    QUALITY = 90
 
+    def listLatestImages(api, name, displaySize=None):
+        sol = catalog.db.getLatestSol(api.ROVER, name)
+        if sol is None: return None
+        return RoverDashboardSync.listSolImages(api, name, sol, displaySize)
 
-    def __init__(self, api, sol):
-        ''' RoverHazcamSync(api, sol)
+
+    def listSolImages(api, name, sol, displaySize=None):
+        images = catalog.db.listImages(api.ROVER, name, sol)
+        if len(images) == 0: return None
+
+        dashImg = images[0]
+        if dashImg.endswith(".png"):
+            # Dashboards synced by older versions were full-size PNG images
+            return makeDisplayImages([ dashImg ], displaySize)[0]
+        return dashImg
+
+
+    def __init__(self, api, sol, name, layout, tileSize, displaySize=None):
+        ''' RoverDashboardSync(api, sol, name, layout, tileSize)
         api - API key
         sol - sol number; if None, will use the latest available sol
+        name - name of the dashboard, used in the sync directory name
+        layout - dict of camera name -> (column, row)
+        tileSize - (width, height) of one tile at full size
+        displaySize - (width, height) the composite should fit in,
+                      or None for full size
         '''
-        super().__init__(api, 'rovers/' + api.ROVER + '-haz', sol)
+        super().__init__(api, 'rovers/' + api.ROVER + '-' + name, name, sol, displaySize)
+        self.layout = layout
+        self.tileSize = self.scaleTile(tuple(tileSize), layout, displaySize)
+
+
+    def hasImagesIn(self, cameras):
+        return any(map(lambda i: i in cameras, self.layout.keys()))
+
+
+    def scaleTile(self, tileSize, layout, displaySize):
+        if displaySize is None: return tileSize
+        columns, rows = getGridSize(layout)
+        scale = min(1.0,
+                    displaySize[0] / (tileSize[0] * columns),
+                    displaySize[1] / (tileSize[1] * rows))
+        return (int(tileSize[0] * scale), int(tileSize[1] * scale))
 
 
-    def sync(self):
+    @tracing.traced("RoverDashboardSync.sync")
+    def sync(self, deadline=None):
+        deadline = deadline or sched.Deadline()
         if self.alreadySynced(): return None
+        start = time.monotonic()
 
-        allImages = list(self.api.listImages(self.sol))
-        hazImages = {
-            "FRONT_HAZCAM_LEFT_A": None,
-            "FRONT_HAZCAM_RIGHT_A": None,
-            "REAR_HAZCAM_LEFT": None,
-            "REAR_HAZCAM_RIGHT": None,
-        }
-        coords = {
-            "FRONT_HAZCAM_LEFT_A": (0, 0),
-            "FRONT_HAZCAM_RIGHT_A": (1280, 0),
-            "REAR_HAZCAM_LEFT": (0, 960),
-            "REAR_HAZCAM_RIGHT": (1280, 960),
-        }
-
-        n = 0
-        for i in hazImages.keys():
-            sel = list(self.filterImages(allImages, i))
+        tiles = {}
+        for i in self.layout.keys():
+            sel = list(self.api.listImages(self.sol, i))
             if len(sel) > 0:
                 sel.sort(key=lambda i:i[0])
-                hazImages[i] = sel[-1][0]
-                n += 1
-
-        logger.debug("HAZ images (%d): %s", n, hazImages)
-        if (n > 0):
-            mkdir(self.syncDir)
-
-            dash = Image.new("RGB", (1280*2, 960*2))
-            for k,i in hazImages.items():
-                if i:
-                    filename = self.downloadImage(i, self.syncDir)
-                    img = Image.open(filename)
-                    dash.paste(img, coords[k])
-
-            logger.debug("Saving HAZ dashboard image")
-            dashImg = os.path.join(self.syncDir,  "dash-" + self.api.ROVER + ".png")
-            if os.path.exists(dashImg): os.unlink(dashImg)
-            dash.save(dashImg)
-            return [ dashImg ]
+                tiles[i] = sel[-1][0]
+
+        logger.debug("Dashboard images (%d): %s", len(tiles), tiles)
+        if len(tiles) == 0:
+            self.markEmpty()
+            return None
+
+        mkdir(self.syncDir)
+        w, h = self.tileSize
+        columns, rows = getGridSize(self.layout)
+        dash = Image.new("RGB", (w * columns, h * rows))
+
+        loaded = 0
+        with concurrent.futures.ThreadPoolExecutor(len(tiles)) as pool:
+            for k, img in zip(tiles.keys(), pool.map(self.loadTile, tiles.values())):
+                if img is None: continue
+                loaded += 1
+                with tracing.span("paste", camera=k):
+                    col, row = self.layout[k]
+                    dash.paste(img, (col * w, row * h))
+
+        deadline.check()
+        if loaded == 0:
+            logger.warning("No %s tiles of %s sol %d loaded, will retry",
+                           self.kind, self.rover, self.sol)
+            return None
+        logger.debug("Saving dashboard image")
+        dashImg = os.path.join(self.syncDir,  "dash-" + self.api.ROVER + ".jpg")
+        tmp = dashImg + ".tmp"
+        with tracing.span("save composite"):
+            dash.save(tmp, "JPEG", quality=self.QUALITY)
+        os.replace(tmp, dashImg)
+        self.addImage(dashImg)
+        # A composite with missing tiles is shown, and completed by the next sync
+        if loaded == len(tiles):
+            self.markSynced()
         else:
+            logger.warning("%d of %d %s tiles of %s sol %d loaded, will retry",
+                           loaded, len(tiles), self.kind, self.rover, self.sol)
+        syncTime.observe(time.monotonic() - start, rover=self.rover, kind=self.kind)
+        return [ dashImg ]
+
+
+    def loadTile(self, url):
+        ''' Download the image and return it scaled to the tile size '''
+        try:
+            filename, digest, size = self.downloadImage(url, self.syncDir)
+            with tracing.span("decode tile", file=filename):
+                return imgload.load(filename, self.tileSize, fit=False,
+                                    resample=Image.BILINEAR)
+        except Exception:
+            logger.exception('Failed to load dashboard tile %s', url)
             return None
 
 
+class RoverHazcamSync(RoverDashboardSync):
+    ''' Sync hazcam images from a rover captured at a specific sol.
+    Creates a composite image from front/rear left/right HAZCAM images.
+    '''
+
+    NAME = "haz"
+    TILE_SIZE = (1280, 960)
+    LAYOUT = {
+        "FRONT_HAZCAM_LEFT_A": (0, 0),
+        "FRONT_HAZCAM_RIGHT_A": (1, 0),
+        "REAR_HAZCAM_LEFT": (0, 1),
+        "REAR_HAZCAM_RIGHT": (1, 1),
+    }
+
+    def listLatestImages(api, displaySize=None):
+        return RoverDashboardSync.listLatestImages(api, RoverHazcamSync.NAME, displaySize)
+
+
+    def __init__(self, api, sol, displaySize=None, layout=None, tileSize=None):
+        ''' RoverHazcamSync(api, sol)
+        api - API key
+        sol - sol number; if None, will use the latest available sol
+        displaySize - (width, height) the composite should fit in,
+                      or None for full size
+        layout - dict of camera name -> (column, row), or None for default
+        tileSize - (width, height) of one tile, or None for default
+        '''
+        super().__init__(api, sol, self.NAME, layout or self.LAYOUT,
+                         tileSize or self.TILE_SIZE, displaySize)
+
+
 # ------------------------------------------------------------------------------
 
 
 class ApodSync:
     def __init__(self, api, outputDir):
         self.api = api
+        self.outputDir = outputDir
         self.outputFile = os.path.join(outputDir, "nasa-apod.jpg")
 
 
-    def sync(self):
+    def sync(self, deadline=None):
         mediaType, url = self.api.getLatestImage()
         logger.info("Latest APOD is %s : %s", mediaType, url)
         if not self.accepts(mediaType): return None
 
         logger.debug("Downloading %s", url)
-        tmp = wget.download(url, tempfile.gettempdir(), bar=None)
+        tmp, digest, size, t = blobstore.download(url, self.outputDir)
 
         if os.path.getsize(tmp) > 0:
             logger.debug("Downloaded APOD")
-            shutil.move(tmp, self.outputFile)
+            os.replace(tmp, self.outputFile)
             return self.outputFile
         else:
             logger.warning("Failed to download APOD: %s", url)
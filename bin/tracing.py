@@ -0,0 +1,117 @@
+import collections
+import functools
+import threading
+import json
+import os
+import time
+import logging
+
+
+logger = logging.getLogger("main")
+
+# Oldest events are dropped beyond this number
+MAX_EVENTS = 200000
+
+# Traces are written here when tracing is turned off
+TRACE_FILE = "trace-%Y%m%d-%H%M%S.json"
+
+enabled = False
+events = collections.deque(maxlen=MAX_EVENTS)
+threadNames = {}
+
+# ------------------------------------------------------------------------------
+
+class Span:
+    ''' Records the time spent in a with block as a complete event '''
+
+    def __init__(self, name, args=None):
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        end = time.perf_counter()
+        t = threading.current_thread()
+        threadNames.setdefault(t.ident, t.name)
+        event = {
+            "name": self.name,
+            "ph": "X",
+            "ts": self.start * 1e6,
+            "dur": (end - self.start) * 1e6,
+            "pid": os.getpid(),
+            "tid": t.ident,
+        }
+        if self.args: event["args"] = self.args
+        events.append(event)
+
+
+class NoSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+NO_SPAN = NoSpan()
+
+def span(name, **args):
+    ''' Return a context manager timing its block while tracing is enabled '''
+    if not enabled: return NO_SPAN
+    return Span(name, args)
+
+
+def traced(name=None, args=None):
+    ''' Decorator timing every call while tracing is enabled.
+    args - optional function of the call arguments returning a dict of
+           details recorded with the span '''
+    def decorate(fn):
+        spanName = name or fn.__qualname__
+
+        @functools.wraps(fn)
+        def wrapper(*a, **kw):
+            if not enabled: return fn(*a, **kw)
+            with Span(spanName, args(*a, **kw) if args else None):
+                return fn(*a, **kw)
+        return wrapper
+    return decorate
+
+
+# ------------------------------------------------------------------------------
+
+def enable():
+    global enabled
+    events.clear()
+    enabled = True
+    logger.info("Tracing enabled")
+
+
+def disable(path=None):
+    ''' Stop tracing and write the trace, returns the file name '''
+    global enabled
+    if not enabled: return None
+    enabled = False
+    path = path or time.strftime(TRACE_FILE)
+    dump(path)
+    logger.info("Tracing disabled, %d events written to %s", len(events), path)
+    return path
+
+
+def toggle():
+    if enabled: disable()
+    else: enable()
+
+
+def dump(path):
+    ''' Write the events in the Chrome trace event format, viewable in
+    chrome://tracing or ui.perfetto.dev '''
+    meta = map(lambda i: { "name": "thread_name", "ph": "M", "pid": os.getpid(),
+                           "tid": i[0], "args": { "name": i[1] } },
+               list(threadNames.items()))
+    tmp = path + ".tmp"
+    with open(tmp, 'w') as f:
+        json.dump({ "traceEvents": list(meta) + list(events), "displayTimeUnit": "ms" }, f)
+    os.replace(tmp, path)